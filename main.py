@@ -1,9 +1,16 @@
 import os
 import re
-import uuid
 import json
-from typing import List, Dict, Any
+import hashlib
+import importlib.metadata
+import string
+import time
+import functools
+from typing import List, Dict, Any, AsyncIterator, Tuple
 import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from types import MappingProxyType
 
 from astrbot.api import logger
 from astrbot.api.event import filter, AstrMessageEvent
@@ -13,68 +20,301 @@ from astrbot.core.provider.entities import LLMResponse, ProviderRequest
 from astrbot.core.star.star_tools import StarTools
 
 import mistune
-from playwright.async_api import async_playwright
+from playwright.async_api import async_playwright, Error as PlaywrightError
+
+# 复用同一个 Markdown 解析器实例，插件组合与 mistune.html 保持一致
+_MISTUNE_PLUGINS = ['strikethrough', 'footnotes', 'table']
+if int(mistune.__version__.split('.')[0]) >= 3:
+    _MISTUNE_PLUGINS.append('speedup')  # mistune 3 提供的解析加速插件
+_MARKDOWN = mistune.create_markdown(escape=False, plugins=_MISTUNE_PLUGINS)
+
+# 图片缓存目录的容量上限，超出后按最近使用时间淘汰；超过保留时间未使用的图片也会被删除
+_IMAGE_CACHE_MAX_BYTES = 200 * 1024 * 1024
+_IMAGE_CACHE_MAX_AGE = 3 * 24 * 3600
+# 内存中保留的最近生成图片数量和总字节数上限，两者任一超出即淘汰最久未用的图片
+_IMAGE_MEMORY_CACHE_SIZE = 128
+_IMAGE_MEMORY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# 代码文件发送后不再使用，保留一天
+_FILE_CACHE_MAX_AGE = 24 * 3600
+# 后台清理缓存目录的间隔（秒）
+_CACHE_SWEEP_INTERVAL = 3600
+
+# 超过该长度的文本在线程中做复杂度检测，短文本直接检测以省去线程切换开销
+_DETECT_IN_THREAD_THRESHOLD = 4096
+# 只缓存不超过该长度的文本的检测结果，避免缓存长文本占用过多内存
+_DETECT_CACHE_MAX_LEN = 4096
+
+# 未配置时允许以文件形式发送的代码语言
+_DEFAULT_SUPPORTED_LANGUAGES = (
+    "python", "javascript", "java", "cpp", "c",
+    "html", "css", "sql", "bash", "shell",
+    "php", "ruby", "go", "rust", "typescript",
+    "json", "xml", "yaml", "markdown"
+)
+
+# 显式<md>标签的匹配正则，模块加载时编译一次，分组1为标签内容
+_MD_TAG_RE = re.compile(r"<md>(.*?)</md>", re.DOTALL)
+
+# 拆分复杂部分使用的扫描正则，按命名分组区分代码块、数学公式、行内代码和表格
+_COMPLEX_SCANNER_RE = re.compile(
+    r'(?P<fence>```(?P<lang>\w+)?\n?(?P<code>[\s\S]*?)\n?```)'
+    r'|(?P<mathblk>\$\$(?P<blk>[\s\S]*?)\$\$)'
+    r'|(?P<mathinl>\$(?P<inl>[^$]+)\$)'
+    r'|(?P<inline>`[^`]+`)'
+    r'|(?P<table>\|.*\|.*\n\|.*---.*\|.*\n(?:\|.*\|.*\n)*)'
+)
+
+# 复杂度检测使用的正则（模块级编译，所有检测器实例共享）
+_CODE_BLOCK_RE = re.compile(r'```[\s\S]*?```', re.MULTILINE)  # 代码块
+_MULTIPLE_HEADINGS_RE = re.compile(r'^#{1,6}\s+.+$(?:\n^#{1,6}\s+.+$){1,}', re.MULTILINE)  # 多个标题
+
+# 应该保持为文本的模式（不转换为图片）
+# 简单链接 [文字](URL) 与纯URL链接；用否定字符类代替懒惰匹配，避免长行上的回溯
+_LINK_RE = re.compile(r'\[[^\]\n]*\]\([^)\n]*\)|https?://\S+')
+
+# 代码块与数学公式的合并扫描正则，按（分离代码块, 分离数学公式）组合预编译
+# 交替分支从左到右匹配，得到的块按位置有序且互不重叠
+_CODE_SCAN_PATTERN = r'```(?P<language>\w+)?\n?(?P<code>.*?)\n?```'
+_MATH_SCAN_PATTERN = r'\$\$(?P<math_block>.*?)\$\$|\$(?P<math_inline>[^$]+)\$'
+_BLOCK_SCAN_RES = {
+    (True, True): re.compile(f'{_CODE_SCAN_PATTERN}|{_MATH_SCAN_PATTERN}', re.DOTALL),
+    (True, False): re.compile(_CODE_SCAN_PATTERN, re.DOTALL),
+    (False, True): re.compile(_MATH_SCAN_PATTERN, re.DOTALL),
+}
+
+# 需要图片渲染的复杂模式（数学公式由 _count_math_delimiters 统计），权重高的在前，便于尽早达到阈值
+# 各模式独立计分（同一段文本可被多个模式计入），不能合并为一个交替正则，
+# 否则先匹配的分支会吞掉其他模式的匹配，例如正文中的 $ 会吞掉其后的代码块
+_COMPLEX_PATTERNS = {
+    'code_block': _CODE_BLOCK_RE,
+    'multiple_headings': _MULTIPLE_HEADINGS_RE,
+}
+
+# 各复杂模式匹配时必然包含的子串，文本中不含时跳过对应正则
+_PATTERN_TRIGGERS = {
+    'code_block': '```',
+    'multiple_headings': '#',
+}
+
+# 各复杂模式的权重，未列出的模式权重为1（表格由逐行扫描统计）
+_PATTERN_WEIGHTS = {
+    'math_block': 3,  # 数学公式和表格权重最高
+    'table': 3,
+    'code_block': 2,  # 代码块权重较高
+}
+
+
+def _count_math_delimiters(text: str) -> Tuple[int, int]:
+    """
+    一次收集全部 $ 的位置，同时统计块级公式（$$...$$）和行内公式（$...$）的数量。
+    两种公式分别计数、互不抢占，结果与分别用块级公式正则（$$ 懒惰匹配到下一个 $$）
+    和行内公式正则（$ 与下一个 $ 之间不含 $ 且非空）逐个匹配的数量一致
+    """
+    positions = []
+    pos = text.find('$')
+    while pos >= 0:
+        positions.append(pos)
+        pos = text.find('$', pos + 1)
+    total = len(positions)
+
+    # 行内公式：相邻两个 $ 之间至少隔一个字符即为一次匹配，之后从闭合的 $ 之后继续
+    inline = 0
+    i = 0
+    while i + 1 < total:
+        if positions[i + 1] - positions[i] > 1:
+            inline += 1
+            i += 2
+        else:
+            i += 1
+
+    # 块级公式：由连续的 $$ 开启，其后最近的另一组 $$ 闭合
+    block = 0
+    i = 0
+    while i + 1 < total:
+        if positions[i + 1] - positions[i] != 1:
+            i += 1
+            continue
+        close = i + 2
+        while close + 1 < total and positions[close + 1] - positions[close] != 1:
+            close += 1
+        if close + 1 >= total:
+            # 之后再没有 $$，剩余的开启符也都无法闭合
+            break
+        block += 1
+        i = close + 2
+    return block, inline
+
+
+def _list_item_indent(line: str) -> int:
+    """返回列表项行的缩进宽度，非列表项返回 -1"""
+    stripped = line.lstrip()
+    indent = len(line) - len(stripped)
+    if not stripped:
+        return -1
+    if stripped[0] in '-*+':
+        marker_end = 1
+    else:
+        marker_end = 0
+        while marker_end < len(stripped) and stripped[marker_end].isdigit():
+            marker_end += 1
+        if marker_end == 0 or stripped[marker_end:marker_end + 1] != '.':
+            return -1
+        marker_end += 1
+    # 标记后必须跟空白字符
+    if marker_end < len(stripped) and stripped[marker_end].isspace():
+        return indent
+    return -1
+
+
+def _child_list_item(lines: List[str], start: int) -> int:
+    """
+    从 start 开始查找紧随其后的子列表项，返回其下标，不存在则返回 -1。
+    子列表项与上一行之间可以有空行，空行的字符（含换行符）与子列表项的缩进
+    合计至少4个空白字符，与原先跨行匹配的 \\s{4,} 判定一致
+    """
+    whitespace = 0
+    while start < len(lines):
+        line = lines[start]
+        if line.strip():
+            indent = _list_item_indent(line)
+            return start if indent >= 0 and whitespace + indent >= 4 else -1
+        whitespace += len(line) + 1
+        start += 1
+    return -1
+
+
+def _count_nested_lists(lines: List[str]) -> int:
+    """逐行统计复杂嵌套列表（列表项后跟缩进>=4的子列表项）的数量，中间的空行不打断列表"""
+    count = 0
+    i = 0
+    total = len(lines)
+    while i < total:
+        if _list_item_indent(lines[i]) < 0:
+            i += 1
+            continue
+        child = _child_list_item(lines, i + 1)
+        if child < 0:
+            i += 1
+            continue
+        count += 1
+        # 跳过同一列表的其余子列表项（包括夹在其间的空行）
+        while child >= 0:
+            i = child + 1
+            child = _child_list_item(lines, i)
+    return count
+
+
+def _is_table_separator(line: str) -> bool:
+    """表头分隔行：以 | 开头，只由 -、:、| 和空白组成，包含 --- 且其后还有 |（兼容 CRLF 行尾）"""
+    if not line.startswith('|') or line.strip('-:| \t\r'):
+        return False
+    dashes = line.find('---', 1)
+    return dashes >= 0 and line.find('|', dashes + 3) >= 0
+
+
+def _count_tables(lines: List[str]) -> int:
+    """逐行统计表格（表头行后紧跟分隔行）的数量，分隔行之后须还有换行"""
+    count = 0
+    i = 0
+    last = len(lines) - 1
+    while i < last:
+        # 表头行只需包含两个 |，数据行须以 | 开头
+        if lines[i].count('|') >= 2 and i + 1 < last and _is_table_separator(lines[i + 1]):
+            count += 1
+            i += 2
+            while i < last and lines[i].startswith('|') and lines[i].count('|') >= 2:
+                i += 1
+        else:
+            i += 1
+    return count
+
+
+def _count_blockquotes(lines: List[str]) -> int:
+    """逐行统计引用块（连续以 > 开头的行）的数量"""
+    count = 0
+    in_quote = False
+    for line in lines:
+        if line.startswith('>'):
+            if not in_quote:
+                count += 1
+                in_quote = True
+        else:
+            in_quote = False
+    return count
 
 
 class MarkdownComplexityDetector:
     """Markdown复杂度检测器，用于判断是否需要转换为图片"""
     
-    def __init__(self):
-        # 定义需要图片渲染的复杂模式
-        self.complex_patterns = {
-            'code_block': re.compile(r'```[\s\S]*?```', re.MULTILINE),  # 代码块
-            'table': re.compile(r'\|.*\|.*\n\|.*---.*\|.*\n(\|.*\|.*\n)*', re.MULTILINE),  # 表格
-            'math_inline': re.compile(r'\$[^$]+\$'),  # 行内数学公式
-            'math_block': re.compile(r'\$\$[\s\S]*?\$\$', re.MULTILINE),  # 块级数学公式
-            'complex_list': re.compile(r'^(?:\s*[-*+]|\s*\d+\.)\s+.*$(?:\n^(?:\s{4,}[-*+]|\s{4,}\d+\.)\s+.*$)+', re.MULTILINE),  # 复杂嵌套列表
-            'blockquote': re.compile(r'^>+.*$(?:\n^>+.*$)*', re.MULTILINE),  # 引用块
-            'multiple_headings': re.compile(r'^#{1,6}\s+.+$(?:\n^#{1,6}\s+.+$){1,}', re.MULTILINE),  # 多个标题
-        }
-        
-        # 定义应该保持为文本的模式（不转换为图片）
-        self.keep_as_text_patterns = {
-            'simple_links': re.compile(r'\[.*?\]\(.*?\)'),  # 简单链接 [文字](URL)
-            'url_links': re.compile(r'https?://[^\s]+'),  # 纯URL链接
-        }
-    
     def needs_rendering(self, text: str, min_complexity_score: int = 2) -> bool:
         """
         判断文本是否需要渲染为图片
         min_complexity_score: 复杂度阈值，达到此分数则转换为图片
         """
+        # 判定只取决于文本和阈值，短文本的结果按内容缓存，重复出现的文本无需再次扫描
+        if len(text) <= _DETECT_CACHE_MAX_LEN:
+            return _needs_rendering_cached(text, min_complexity_score)
+        return self._needs_rendering(text, min_complexity_score)
+    
+    def _needs_rendering(self, text: str, min_complexity_score: int) -> bool:
+        """needs_rendering 的实际检测逻辑"""
         if not text.strip():
             return False
+        
+        # 快速路径：单行且不含 $ 和反引号的文本不可能匹配公式、代码、表格或多标题，
+        # 最多只有引用块的1分，不足阈值时无需运行任何正则
+        if '\n' not in text and '$' not in text and '`' not in text:
+            if (1 if text.startswith('>') else 0) < min_complexity_score:
+                return False
             
         # 如果只有链接，直接返回不需要转换
         if self._only_contains_links(text):
             return False
             
-        complexity_score = 0
-        
-        # 检测复杂模式
-        for pattern_name, pattern in self.complex_patterns.items():
-            matches = pattern.findall(text)
-            if matches:
-                if pattern_name == 'code_block':
-                    complexity_score += len(matches) * 2  # 代码块权重较高
-                elif pattern_name in ['math_block', 'table']:
-                    complexity_score += len(matches) * 3  # 数学公式和表格权重最高
-                else:
-                    complexity_score += len(matches)
-        
-        # 如果包含多个复杂元素，直接需要渲染
-        if complexity_score >= min_complexity_score:
-            return True
-            
         # 检测文本长度（过长的纯文本在QQ中显示效果也不好）
-        lines = text.split('\n')
-        if len(lines) > 15:  # 超过15行考虑渲染
+        # 直接数换行符，长文本无需切分成行列表
+        if text.count('\n') >= 15:  # 超过15行考虑渲染
             return True
+        
+        # 此时最多15行，切分开销很小
+        lines = text.split('\n')
             
         # 检测行长度（避免过长的行在移动端显示问题）
-        long_lines = [line for line in lines if len(line.strip()) > 80]
-        if len(long_lines) > 3:  # 多行超过80字符
+        long_line_count = 0
+        for line in lines:
+            # 先用原始长度过滤，短行无需 strip
+            if len(line) > 80 and len(line.strip()) > 80:
+                long_line_count += 1
+                if long_line_count > 3:  # 多行超过80字符
+                    return True
+        
+        # 嵌套列表、表格和引用块使用逐行扫描，避免正则回溯
+        # 先用子串检查排除不可能出现的结构，省去对应的扫描
+        complexity_score = _count_nested_lists(lines)
+        if '|' in text:
+            complexity_score += _count_tables(lines) * _PATTERN_WEIGHTS['table']
+        if '>' in text:
+            complexity_score += _count_blockquotes(lines)
+        if complexity_score >= min_complexity_score:
             return True
+        
+        # 块级公式和行内公式共用一次 $ 位置扫描，各自计分
+        if '$' in text:
+            math_blocks, math_inlines = _count_math_delimiters(text)
+            complexity_score += (math_blocks * _PATTERN_WEIGHTS['math_block']
+                                 + math_inlines * _PATTERN_WEIGHTS.get('math_inline', 1))
+            if complexity_score >= min_complexity_score:
+                return True
+        
+        # 其余模式逐个计分，达到阈值即返回，无需继续扫描
+        for pattern_name, pattern in _COMPLEX_PATTERNS.items():
+            if _PATTERN_TRIGGERS[pattern_name] not in text:
+                continue
+            weight = _PATTERN_WEIGHTS.get(pattern_name, 1)
+            for _ in pattern.finditer(text):
+                complexity_score += weight
+                if complexity_score >= min_complexity_score:
+                    return True
             
         return False
     
@@ -87,579 +327,926 @@ class MarkdownComplexityDetector:
         if not text:
             return False
             
-        # 检查是否包含链接
-        has_links = False
-        for pattern_name, pattern in self.keep_as_text_patterns.items():
-            if pattern.search(text):
-                has_links = True
-                break
-        
-        if not has_links:
-            return False
+        # 文本很短且包含链接时直接保持为文本，只需找到第一个链接
+        total_length = len(text)
+        if total_length < 200:
+            return _LINK_RE.search(text) is not None
             
         # 如果文本主要是链接，则保持为文本
-        # 计算链接部分占整个文本的比例
-        total_length = len(text)
+        # 单次扫描累计链接长度，超过文本的60%即可返回
+        link_threshold = total_length * 0.6
         link_length = 0
-        
-        for pattern_name, pattern in self.keep_as_text_patterns.items():
-            for match in pattern.finditer(text):
-                link_length += len(match.group(0))
-        
-        # 如果链接部分超过文本的60%，或者文本很短且包含链接
-        link_ratio = link_length / total_length if total_length > 0 else 0
-        if link_ratio > 0.6 or (total_length < 200 and has_links):
-            return True
+        for match in _LINK_RE.finditer(text):
+            link_length += match.end() - match.start()
+            if link_length > link_threshold:
+                return True
             
         return False
     
-    def extract_code_blocks(self, text: str) -> List[Dict[str, Any]]:
-        """提取代码块"""
-        code_blocks = []
-        # 修复正则表达式，正确处理代码块
-        pattern = re.compile(r'```(\w+)?\n?(.*?)\n?```', re.DOTALL)
-        
-        for match in pattern.finditer(text):
-            language = match.group(1) or 'text'
-            code_content = match.group(2).strip()
-            code_blocks.append({
-                'language': language,
-                'content': code_content,
-                'full_match': match.group(0),  # 保存完整匹配，用于后续替换
-                'start': match.start(),
-                'end': match.end()
-            })
-        
-        return code_blocks
-    
-    def extract_math_blocks(self, text: str) -> List[Dict[str, Any]]:
-        """提取数学公式块"""
-        math_blocks = []
-        
-        # 提取行内数学公式
-        inline_pattern = re.compile(r'\$([^$]+)\$')
-        for match in inline_pattern.finditer(text):
-            math_content = match.group(1).strip()
-            math_blocks.append({
-                'type': 'inline',
-                'content': math_content,
-                'full_match': match.group(0),
-                'start': match.start(),
-                'end': match.end()
-            })
-        
-        # 提取块级数学公式
-        block_pattern = re.compile(r'\$\$(.*?)\$\$', re.DOTALL)
-        for match in block_pattern.finditer(text):
-            math_content = match.group(1).strip()
-            math_blocks.append({
-                'type': 'block',
-                'content': math_content,
-                'full_match': match.group(0),
-                'start': match.start(),
-                'end': match.end()
-            })
-        
-        return math_blocks
+    def scan_blocks(self, text: str, code: bool = True, math: bool = True) -> List[Dict[str, Any]]:
+        """一次扫描按出现顺序提取代码块和数学公式块"""
+        scanner = _BLOCK_SCAN_RES.get((code, math))
+        if scanner is None:
+            return []
+        
+        blocks = []
+        for match in scanner.finditer(text):
+            kind = match.lastgroup
+            if kind == 'code':
+                block = {
+                    'block_type': 'code',
+                    'language': match.group('language') or 'text',
+                    'content': match.group('code').strip()
+                }
+            else:
+                block = {
+                    'block_type': 'math',
+                    'type': 'block' if kind == 'math_block' else 'inline',
+                    'content': match.group(kind).strip()
+                }
+            block['full_match'] = match.group(0)
+            block['start'] = match.start()
+            block['end'] = match.end()
+            blocks.append(block)
+        
+        return blocks
+
+
+# 检测器不保存状态，缓存放在模块级并由所有实例共享，缓存键只有文本和阈值
+_SHARED_DETECTOR = MarkdownComplexityDetector()
+
+
+@functools.lru_cache(maxsize=512)
+def _needs_rendering_cached(text: str, min_complexity_score: int) -> bool:
+    """带缓存的 needs_rendering 检测，仅用于短文本"""
+    return _SHARED_DETECTOR._needs_rendering(text, min_complexity_score)
 
 # 字体大小配置 - 方便测试调整
 code_font_size = 13
 line_height = 1.5
-from bs4 import BeautifulSoup
+
+# mistune 输出的代码块结构，分组1为 class 属性，分组2为（已转义的）代码文本
+_PRE_CODE_RE = re.compile(r'<pre><code(?:\s+class="([^"]*)")?>([\s\S]*?)</code></pre>')
+_CODE_LANG_RE = re.compile(r'language-(\w+)')
+
+
+def _render_code_block(match) -> str:
+    """把一个 <pre><code> 代码块替换为带标题栏和行号的结构"""
+    code_class = match.group(1) or ''
+    code_html = match.group(2)
+    
+    # 获取语言
+    lang_match = _CODE_LANG_RE.search(code_class)
+    lang = lang_match.group(1) if lang_match else 'text'
+    
+    # 统计行数，末尾空行不计
+    line_count = max(code_html.rstrip('\n').count('\n') + 1, 1)
+    line_numbers = ''.join(f'<div class="line-number">{i}</div>' for i in range(1, line_count + 1))
+    
+    return (
+        f'<div class="code-container"><div class="code-header">{lang}</div>'
+        f'<div class="code-content"><div class="line-numbers">{line_numbers}</div>'
+        f'<div class="code-wrapper"><pre><code class="{code_class}">{code_html}</code></pre></div>'
+        f'</div></div>'
+    )
+
+
 def process_code_blocks_in_html(html_content: str) -> str:
     """在Python中预处理代码块，生成带行号的HTML"""
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # 找到所有代码块
-    for pre in soup.find_all('pre'):
-        code = pre.find('code')
-        if not code:
+    if '<pre>' not in html_content:
+        return html_content
+    return _PRE_CODE_RE.sub(_render_code_block, html_content)
+
+
+# KaTeX 资源，仅在 Markdown 含有数学公式时注入页面
+_KATEX_ASSETS = """<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.css">
+            <script src="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.js"></script>
+            <script src="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/contrib/auto-render.min.js"></script>"""
+
+
+def _screenshot_options(output_image_path: str = None, image_type: str = 'png') -> Dict[str, Any]:
+    """
+    选择截图格式，JPEG 编码更快、体积更小
+    提供输出路径时按扩展名判断格式，否则使用 image_type 且只返回图片字节
+    """
+    if output_image_path is not None:
+        image_type = 'jpeg' if output_image_path.lower().endswith(('.jpg', '.jpeg')) else 'png'
+    options = {'path': output_image_path, 'type': image_type}
+    if image_type == 'jpeg':
+        options['quality'] = 85
+    return options
+
+
+def _playwright_version() -> str:
+    """获取已安装的 Playwright 版本号"""
+    try:
+        return importlib.metadata.version("playwright")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def _touch_if_exists(path: str) -> bool:
+    """文件存在时刷新其修改时间（供缓存淘汰参考）并返回 True"""
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+def _remove_if_exists(path: str):
+    """删除文件，文件不存在时忽略"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _prune_dir(directory: str, max_bytes: int = None, max_age: float = None) -> tuple:
+    """
+    清理目录中的文件：先删除修改时间早于 max_age 秒前的文件，
+    再按修改时间从旧到新删除，直到总大小不超过 max_bytes
+    返回 (删除的文件数, 剩余总大小)
+    """
+    entries = []
+    total_size = 0
+    removed = 0
+    expire_before = time.time() - max_age if max_age is not None else None
+    for entry in os.scandir(directory):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        if expire_before is not None and stat.st_mtime < expire_before:
+            _remove_if_exists(entry.path)
+            removed += 1
             continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size += stat.st_size
+    if max_bytes is not None and total_size > max_bytes:
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= max_bytes:
+                break
+            _remove_if_exists(path)
+            total_size -= size
+            removed += 1
+    return removed, total_size
+
+
+def _write_file_atomic(path: str, body: bytes):
+    """写入文件，先写临时文件再替换，避免并发读取到不完整的内容"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.urandom(4).hex()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(body)
+    os.replace(temp_path, path)
+
+
+def _contains_math(md_text: str) -> bool:
+    """粗略判断 Markdown 是否包含数学公式定界符"""
+    return '$' in md_text or '\\(' in md_text or '\\[' in md_text
+
+
+async def _render_html_on_page(page, full_html: str, output_image_paths: List[str], has_math: bool = True,
+                               image_type: str = 'png') -> List[bytes]:
+    """在给定页面中渲染HTML，并按 chunk-<序号> 元素逐个截图，返回各片段的图片字节"""
+    await page.set_content(full_html, wait_until="domcontentloaded")
+    return await _render_loaded_page(page, output_image_paths, has_math, image_type)
+
+
+# 页面池预热的超时时间，预热只为填充资源缓存，离线时应尽快放弃
+_PAGE_WARMUP_TIMEOUT_MS = 5000
+
+# 片段元素截图的超时时间，元素由我们自己生成，找不到时应尽快退回整页截图
+_ELEMENT_SCREENSHOT_TIMEOUT_MS = 5000
+
+# 等待 renderAll 完成的上限（秒），字体或脚本加载卡住时不再无限占用页面
+_RENDER_TIMEOUT_S = 10
+
+
+async def _render_loaded_page(page, output_image_paths: List[str], has_math: bool = True,
+                              image_type: str = 'png') -> List[bytes]:
+    """对已载入内容的页面执行高亮和公式渲染，并按 chunk-<序号> 元素逐个截图"""
+    try:
+        # 代码高亮和 KaTeX 渲染均为同步调用，renderAll 返回的 Promise 在字体加载完成后才结束，
+        # evaluate 等待它即表示渲染完成，无需轮询；超时后直接用当前内容截图
+        await asyncio.wait_for(page.evaluate("window.renderAll()"), timeout=_RENDER_TIMEOUT_S)
+        
+        # 检查数学公式是否渲染成功
+        if has_math:
+            math_elements = await page.query_selector_all('.katex, .katex-display')
+            if math_elements:
+                logger.info(f"检测到 {len(math_elements)} 个数学公式元素")
+            else:
+                logger.warning("未检测到数学公式元素，可能渲染失败")
+        
+    except asyncio.TimeoutError:
+        logger.warning(f"等待渲染完成超过 {_RENDER_TIMEOUT_S} 秒，使用当前页面内容截图")
+    except Exception as e:
+        logger.warning(f"渲染警告: {e}")
+        # 即使有警告也继续，可能部分内容已经渲染完成
+
+    # 截图，每个片段直接通过 locator 对自身元素截图，省去单独查询元素句柄的往返
+    images = []
+    for index, output_image_path in enumerate(output_image_paths):
+        screenshot_options = _screenshot_options(output_image_path, image_type)
+        chunk = page.locator(f'#chunk-{index}')
+        try:
+            images.append(await chunk.screenshot(
+                omit_background=False, timeout=_ELEMENT_SCREENSHOT_TIMEOUT_MS, **screenshot_options
+            ))
+        except PlaywrightError as e:
+            # 页面中还有同批其他消息的内容，不能退回整页截图；改为按该片段的位置裁剪，
+            # 取不到位置时抛出，由调用方逐个重新渲染
+            logger.warning(f"片段截图失败，改为按片段位置裁剪: {e}")
+            bounding_box = await chunk.bounding_box(timeout=_ELEMENT_SCREENSHOT_TIMEOUT_MS)
+            if not bounding_box:
+                raise
+            images.append(await page.screenshot(full_page=True, clip=bounding_box, **screenshot_options))
+    return images
+
+
+def _context_options(scale: int, width: int = None) -> Dict[str, Any]:
+    """
+    浏览器上下文参数
+    已知渲染宽度时把视口收窄到内容宽度附近，布局和截图不再处理默认 1280 宽的视口
+    """
+    options = {'device_scale_factor': scale, 'service_workers': 'block'}
+    if width:
+        options['viewport'] = {'width': width + 50, 'height': 800}
+    return options
+
+
+async def _render_html_with_browser(browser, full_html: str, output_image_paths: List[str], scale: int,
+                                    has_math: bool = True, image_type: str = 'png',
+                                    width: int = None) -> List[bytes]:
+    """在已启动的浏览器中新建上下文渲染HTML并截图"""
+    context = await browser.new_context(**_context_options(scale, width))
+    try:
+        page = await context.new_page()
+        return await _render_html_on_page(page, full_html, output_image_paths, has_math, image_type)
+    finally:
+        await context.close()
+
+
+# 只做静态页面截图，关闭 GPU、扩展、后台联网等用不到的 Chromium 功能
+_CHROMIUM_ARGS = [
+    "--no-sandbox",
+    "--disable-gpu",
+    "--disable-dev-shm-usage",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-sync",
+    "--disable-translate",
+    "--mute-audio",
+    "--no-first-run",
+    "--no-default-browser-check",
+    # 池中空闲页面被视为后台页面，避免其定时器和渲染帧被节流
+    "--disable-background-timer-throttling",
+    "--disable-renderer-backgrounding",
+    "--disable-features=TranslateUI,BackForwardCache",
+]
+
+# 需要在本地缓存的 CDN 资源（KaTeX、highlight.js 及其字体）
+_CDN_ROUTE_PATTERNS = (
+    "https://cdn.jsdelivr.net/**",
+    "https://cdnjs.cloudflare.com/**",
+)
+
+_ASSET_CONTENT_TYPES = {
+    '.js': 'application/javascript',
+    '.css': 'text/css',
+    '.woff2': 'font/woff2',
+    '.woff': 'font/woff',
+    '.ttf': 'font/ttf',
+}
+
+# 已加载的 CDN 资源内容，按本地缓存路径索引，所有页面共享
+_ASSET_BODIES: Dict[str, bytes] = {}
+
+
+def _read_file_if_exists(path: str) -> bytes:
+    """读取文件内容，文件不存在时返回 None"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+async def _route_cdn_assets(context, asset_dir: str):
+    """拦截 CDN 请求：本地已缓存则直接返回文件，否则联网获取一次并写入本地"""
+    async def handle(route):
+        url = route.request.url
+        ext = os.path.splitext(url.split('?', 1)[0])[1].lower()
+        local_path = os.path.join(asset_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + ext)
+        headers = {'Access-Control-Allow-Origin': '*'}
+        # 资源内容在内存中保留一份，之后的页面加载无需再读磁盘
+        body = _ASSET_BODIES.get(local_path)
+        if body is None:
+            body = await asyncio.to_thread(_read_file_if_exists, local_path)
+            if body is not None:
+                _ASSET_BODIES[local_path] = body
+        if body is not None:
+            await route.fulfill(
+                body=body,
+                content_type=_ASSET_CONTENT_TYPES.get(ext, 'application/octet-stream'),
+                headers=headers
+            )
+            return
+        try:
+            response = await route.fetch()
+            body = await response.body()
+        except Exception as e:
+            logger.warning(f"获取CDN资源失败: {url}: {e}")
+            await route.abort()
+            return
+        if response.ok:
+            _ASSET_BODIES[local_path] = body
+            try:
+                await asyncio.to_thread(_write_file_atomic, local_path, body)
+            except OSError as e:
+                logger.warning(f"缓存CDN资源失败: {url}: {e}")
+        await route.fulfill(response=response, body=body)
+
+    for pattern in _CDN_ROUTE_PATTERNS:
+        await context.route(pattern, handle)
+
+
+class PagePool:
+    """预热的 Playwright 页面池，每个页面拥有独立的 BrowserContext，渲染时轮流借用"""
+
+    def __init__(self, browser, size: int = 2, scale: int = 2, asset_dir: str = None, width: int = 600):
+        self.browser = browser
+        self.size = size
+        self.scale = scale
+        self.width = width
+        # 提供时，CDN 资源经路由拦截从该目录的本地副本加载
+        self.asset_dir = asset_dir
+        self._contexts = []
+        self._pages = asyncio.Queue()
+        # 每个页面当前载入的模板外壳（内容前后两段），相同外壳只需替换 body
+        self._shells = {}
+
+    async def start(self):
+        """创建上下文和页面，并预先加载 KaTeX 资源以填充缓存"""
+        pages = []
+        for _ in range(self.size):
+            context = await self.browser.new_context(**_context_options(self.scale, self.width))
+            self._contexts.append(context)
+            if self.asset_dir:
+                await _route_cdn_assets(context, self.asset_dir)
+            pages.append(await context.new_page())
+        # 各页面并行预热且限时，离线时不会让初始化按页面数成倍阻塞
+        await asyncio.gather(*(self._warm_up(page) for page in pages))
+        for page in pages:
+            self._pages.put_nowait(page)
+
+    @staticmethod
+    async def _warm_up(page):
+        """载入 KaTeX 资源填充缓存，失败只影响首次渲染速度"""
+        try:
+            await page.set_content(
+                f"<html><head>{_KATEX_ASSETS}</head><body></body></html>",
+                wait_until="load",
+                timeout=_PAGE_WARMUP_TIMEOUT_MS
+            )
+        except Exception as e:
+            logger.warning(f"页面预热失败: {e}")
+
+    async def _replace_page(self, page):
+        """关闭出错的页面并在同一上下文中换一个新页面，新建失败时仍返回原页面"""
+        self._shells.pop(page, None)
+        try:
+            await page.close()
+        except Exception:
+            pass
+        try:
+            return await page.context.new_page()
+        except Exception as e:
+            logger.warning(f"重建渲染页面失败: {e}")
+            return page
+
+    @asynccontextmanager
+    async def page(self):
+        """借出一个页面，池中无空闲页面时等待，用完后归还"""
+        page = await self._pages.get()
+        try:
+            if page.is_closed():
+                self._shells.pop(page, None)
+                page = await page.context.new_page()
+            yield page
+        except Exception:
+            # 渲染进程崩溃等情况下页面不会自动关闭，继续复用只会让之后的渲染全部失败，
+            # 因此出错的页面一律换成新页面再放回池中
+            page = await self._replace_page(page)
+            raise
+        finally:
+            self._pages.put_nowait(page)
+
+    async def render(self, shell: tuple, body_html: str, output_image_paths: List[str],
+                     has_math: bool = True, image_type: str = 'png') -> List[bytes]:
+        """
+        借用页面渲染内容并截图
+        页面已载入同一模板外壳时只替换 body，KaTeX 和 highlight.js 脚本无需重新下载和解析
+        """
+        async with self.page() as page:
+            if self._shells.get(page) != shell:
+                self._shells.pop(page, None)
+                await page.set_content(shell[0] + shell[1], wait_until="domcontentloaded")
+                self._shells[page] = shell
+            await page.evaluate("html => { document.body.innerHTML = html; }", body_html)
+            return await _render_loaded_page(page, output_image_paths, has_math, image_type)
+
+    async def close(self):
+        """关闭池中所有上下文"""
+        for context in self._contexts:
+            try:
+                await context.close()
+            except Exception as e:
+                logger.warning(f"关闭浏览器上下文失败: {e}")
+        self._contexts = []
+        self._shells = {}
+
+
+async def markdown_to_image_playwright(
+    md_text: str,
+    output_image_path: str,
+    scale: int = 2,
+    width: int = 600,
+    browser=None,
+    page_pool: PagePool = None
+):
+    """
+    使用 Playwright 将 Markdown 转换为图片（修复格式化版本）
+    browser: 可选的常驻浏览器实例，提供时复用它而不是每次重新启动
+    page_pool: 可选的预热页面池，缩放比例一致时优先从池中借用页面
+    """
+    await markdown_chunks_to_images_playwright(
+        [md_text], [output_image_path], scale=scale, width=width,
+        browser=browser, page_pool=page_pool
+    )
+
+
+class _HtmlTemplate(string.Template):
+    """只识别 ${name} 形式占位符的模板，避免与公式定界符 $ 以及 CSS/JS 中的花括号冲突"""
+    pattern = r"""
+    \$(?:
+        (?P<escaped>(?!))|
+        (?P<named>(?!))|
+        \{(?P<braced>[_a-z][_a-z0-9]*)\}|
+        (?P<invalid>(?!))
+    )
+    """
+
+
+# 页面模板，模块加载时构造一次
+_HTML_TEMPLATE = _HtmlTemplate("""
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>Markdown Render</title>
+    <style>
+        * {
+            margin: 0;
+            padding: 0;
+            box-sizing: border-box;
+        }
         
-        # 获取语言和文本
-        lang = 'text'
-        if code.get('class'):
-            match = re.search(r'language-(\w+)', ' '.join(code.get('class')))
-            if match:
-                lang = match.group(1)
+        body {
+            ${width_style}
+            font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Helvetica, Arial, sans-serif;
+            padding: 20px;
+            font-size: 16px;
+            line-height: 1.6;
+            background-color: #ffffff;
+            color: #24292e;
+        }
         
-        # 获取原始文本内容
-        text_content = code.get_text()
-        lines = text_content.split('\n')
+        .content-wrapper {
+            padding: 0;
+        }
+
+        /* 数学公式样式 - 确保正确显示 */
+        .math-container {
+            margin: 10px 0;
+            padding: 10px;
+            text-align: center;
+        }
         
-        # 移除末尾空行
-        while lines and lines[-1] == '':
-            lines.pop()
+        .math-inline {
+            display: inline;
+            margin: 0 2px;
+        }
         
-        if not lines:
-            lines = ['']
+        .math-block {
+            display: block;
+            margin: 15px 0;
+        }
         
-        line_count = len(lines)
+        .math-error {
+            color: #dc2626;
+            background: #fef2f2;
+            border: 1px solid #fecaca;
+            padding: 8px 12px;
+            border-radius: 4px;
+            font-family: monospace;
+        }
         
-        # 构建新的HTML结构
-        container = soup.new_tag('div', attrs={'class': 'code-container'})
+        /* 代码块容器样式 */
+        .code-container {
+            position: relative;
+            margin: 8px 0;
+            border-radius: 4px;
+            overflow: hidden;
+            box-shadow: 0 1px 2px rgba(0, 0, 0, 0.1);
+        }
         
-        # 标题栏
-        header = soup.new_tag('div', attrs={'class': 'code-header'})
-        header.string = lang
-        container.append(header)
+        /* 代码标题栏 */
+        .code-header {
+            background: #2d3747;
+            color: #e5e7eb;
+            padding: 6px 12px;
+            font-size: 12px;
+            font-weight: 500;
+            border-bottom: 1px solid #3e4c5e;
+        }
         
-        # 内容区域
-        content = soup.new_tag('div', attrs={'class': 'code-content'})
+        /* 代码内容区域 */
+        .code-content {
+            display: flex;
+            background: #1e293b;
+            margin: 0;
+        }
         
-        # 行号
-        line_nums = soup.new_tag('div', attrs={'class': 'line-numbers'})
-        for i in range(1, line_count + 1):
-            line_num = soup.new_tag('div', attrs={'class': 'line-number'})
-            line_num.string = str(i)
-            line_nums.append(line_num)
-        content.append(line_nums)
+        /* 行号样式 */
+        .line-numbers {
+            background: #1a2332;
+            color: #64748b;
+            padding: 8px 0;
+            text-align: right;
+            font-family: 'SFMono-Regular', Consolas, 'Liberation Mono', Menlo, monospace;
+            font-size: ${code_font_size}px;
+            line-height: ${line_height};
+            user-select: none;
+            border-right: 1px solid #334155;
+            min-width: 40px;
+            flex-shrink: 0;
+            padding-right: 8px;
+        }
         
-        # 代码包装
-        code_wrapper = soup.new_tag('div', attrs={'class': 'code-wrapper'})
-        new_pre = soup.new_tag('pre')
-        new_code = soup.new_tag('code', attrs={'class': code.get('class', [])})
-        new_code.string = text_content  # 保留原始文本
-        new_pre.append(new_code)
-        code_wrapper.append(new_pre)
-        content.append(code_wrapper)
+        .line-number {
+            display: block;
+            height: auto;
+        }
         
-        container.append(content)
+        /* 代码区域 */
+        .code-wrapper {
+            flex: 1;
+            overflow-x: auto;
+            padding: 8px 12px;
+        }
         
-        # 替换原来的pre标签
-        pre.replace_with(container)
-    
-    return str(soup)
-
-
-# 在 safe_format 函数中添加调试
-def safe_format(template, **kwargs):
-    """安全的字符串格式化，忽略不存在的键"""
-    import string
-    from string import Formatter
+        .code {
+            font-family: 'SFMono-Regular', Consolas, 'Liberation Mono', Menlo, monospace;
+            font-size: ${code_font_size}px;
+            line-height: ${line_height};
+            color: #e2e8f0;
+            background: transparent;
+            margin: 0;
+            padding: 0;
+            white-space: pre;
+            tab-size: 4;
+            -moz-tab-size: 4;
+        }
+        
+        pre {
+            font-family: 'SFMono-Regular', Consolas, 'Liberation Mono', Menlo, monospace !important;
+            white-space: pre !important;
+            margin: 0 !important;
+            padding: 0 !important;
+            tab-size: 4 !important;
+            -moz-tab-size: 4 !important;
+            background: transparent !important;
+        }
+        
+        code {
+            font-family: 'SFMono-Regular', Consolas, 'Liberation Mono', Menlo, monospace !important;
+            white-space: pre !important;
+            tab-size: 4 !important;
+            -moz-tab-size: 4 !important;
+            background: transparent !important;
+            font-size: ${code_font_size}px !important;
+            line-height: ${line_height} !important;
+        }
+        
+        .hljs {
+            font-family: 'SFMono-Regular', Consolas, 'Liberation Mono', Menlo, monospace !important;
+            white-space: pre !important;
+            background: transparent !important;
+            padding: 0 !important;
+            margin: 0 !important;
+            display: block !important;
+            tab-size: 4 !important;
+            -moz-tab-size: 4 !important;
+            font-size: ${code_font_size}px !important;
+            line-height: ${line_height} !important;
+        }
+        
+        p { margin: 8px 0; }
+        h1, h2, h3, h4, h5, h6 { margin: 12px 0 6px 0; }
+        ul, ol { margin: 6px 0; padding-left: 24px; }
+        li { margin: 2px 0; }
+        blockquote { border-left: 2px solid #dfe2e5; padding-left: 12px; margin: 6px 0; color: #6a737d; }
+        table { border-collapse: collapse; width: 100%; margin: 8px 0; font-size: 12px; }
+        th, td { border: 1px solid #dfe2e5; padding: 4px 8px; text-align: left; }
+        th { background-color: #f6f8fa; font-weight: 600; }
+    </style>
     
-    formatter = Formatter()
-    valid_keys = set()
-    for literal_text, field_name, format_spec, conversion in formatter.parse(template):
-        if field_name is not None:
-            valid_keys.add(field_name)
+    <!-- 使用 KaTeX - 更快速可靠的数学公式渲染，仅在内容包含公式时注入 -->
+    ${math_assets}
     
-    # 调试信息
-    missing_keys = valid_keys - set(kwargs.keys())
-    if missing_keys:
-        logger.warning(f"模板中缺少以下键: {missing_keys}")
+    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/styles/github-dark.min.css">
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/highlight.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/python.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/javascript.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/java.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/cpp.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/c.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/html.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/css.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/sql.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/bash.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/json.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/xml.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/yaml.min.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/markdown.min.js"></script>
     
-    safe_kwargs = {k: v for k, v in kwargs.items() if k in valid_keys}
-    return template.format(**safe_kwargs)
+    <script>
+        // 渲染入口，由 Playwright 在页面加载后显式调用并等待其返回
+        window.renderAll = function() {
+            // 高亮代码块
+            hljs.highlightAll();
+            
+            // KaTeX 数学公式渲染（未注入 KaTeX 时跳过）
+            if (window.renderMathInElement) renderMathInElement(document.body, {
+                delimiters: [
+                    {left: '$$', right: '$$', display: true},
+                    {left: '$', right: '$', display: false},
+                    {left: '\\\\(', right: '\\\\)', display: false},
+                    {left: '\\\\[', right: '\\\\]', display: true}
+                ],
+                throwOnError: false,
+                errorColor: '#cc0000',
+                // 截图只需要可见的 HTML 输出，跳过辅助功能用的 MathML 生成
+                output: 'html',
+                // 关闭严格模式检查，避免逐个公式产生告警
+                strict: 'ignore',
+                macros: {
+                    "\\RR": "\\\\mathbb{R}",
+                    "\\CC": "\\\\mathbb{C}", 
+                    "\\QQ": "\\\\mathbb{Q}",
+                    "\\ZZ": "\\\\mathbb{Z}",
+                    "\\NN": "\\\\mathbb{N}",
+                    "\\bm": "\\\\boldsymbol{#1}",
+                    "\\abs": ["\\\\left|#1\\\\right|", 1],
+                    "\\norm": ["\\\\left\\\\|#1\\\\right\\\\|", 1]
+                }
+            });
+            
+            // 公式和代码用到的 Web 字体异步加载，返回的 Promise 在字体就绪、
+            // 且之后的两帧绘制完成后才结束，此时 DOM 变更均已生效
+            return document.fonts.ready.then(() => new Promise(resolve => {
+                requestAnimationFrame(() => requestAnimationFrame(() => resolve(true)));
+            }));
+        };
+    </script>
+</head>
+<body>
+    ${content}
+</body>
+</html>
+""")
 
-async def markdown_to_image_playwright(
-    md_text: str,
-    output_image_path: str,
+
+@functools.lru_cache(maxsize=16)
+def _html_shell(width_style: str, has_math: bool, font_size, height) -> tuple:
+    """按渲染参数生成一次模板，拆成内容前后两段，之后每次渲染只需拼接内容"""
+    filled = _HTML_TEMPLATE.safe_substitute(
+        width_style=width_style,
+        math_assets=_KATEX_ASSETS if has_math else "",
+        code_font_size=font_size,
+        line_height=height
+    )
+    prefix, suffix = filled.split("${content}", 1)
+    return prefix, suffix
+
+
+async def markdown_chunks_to_images_playwright(
+    md_texts: List[str],
+    output_image_paths: List[str] = None,
     scale: int = 2,
-    width: int = 600
-):
+    width: int = 600,
+    browser=None,
+    page_pool: PagePool = None,
+    image_type: str = 'png'
+) -> List[bytes]:
     """
-    使用 Playwright 将 Markdown 转换为图片（修复格式化版本）
+    在同一个页面中一次渲染多段 Markdown，返回每段的图片字节
+    每段内容包裹在独立的 content-wrapper 中，按其包围盒裁剪
+    output_image_paths: 可选，提供时同时把截图写入对应路径（格式由扩展名决定）
+    image_type: 未提供输出路径时使用的图片格式（png / jpeg）
     """
-    def safe_format(template, **kwargs):
-        """安全的字符串格式化，忽略不存在的键"""
-        import string
-        from string import Formatter
-        
-        formatter = Formatter()
-        valid_keys = set()
-        for literal_text, field_name, format_spec, conversion in formatter.parse(template):
-            if field_name is not None:
-                valid_keys.add(field_name)
+    if output_image_paths is None:
+        output_image_paths = [None] * len(md_texts)
+    width_style = f"width: {width}px; box-sizing: border-box;" if width else ""
+    
+    try:
+        # 没有公式时不加载 KaTeX，省去脚本下载、解析和渲染
+        has_math = any(_contains_math(md_text) for md_text in md_texts)
+
+        chunk_htmls = []
+        for index, md_text in enumerate(md_texts):
+            # 第一步：Markdown -> HTML
+            html_content = _MARKDOWN(md_text)
+            
+            # 第二步：预处理数学公式
+            processed_html = preprocess_math_formulas(html_content)
+            
+            # 第三步：Python预处理代码块，加上行号
+            processed_html = process_code_blocks_in_html(processed_html)
+            chunk_htmls.append(
+                f'<div class="content-wrapper" id="chunk-{index}">{processed_html}</div>'
+            )
         
-        safe_kwargs = {k: v for k, v in kwargs.items() if k in valid_keys}
-        return template.format(**safe_kwargs)
+        # 第四步：拼接缓存的模板前后段生成完整HTML，内容中的花括号无需转义
+        shell = _html_shell(width_style, has_math, code_font_size, line_height)
+        body_html = '\n'.join(chunk_htmls)
+        full_html = shell[0] + body_html + shell[1]
+
+        if page_pool is not None and browser is None:
+            browser = page_pool.browser
+
+        if (page_pool is not None and page_pool.scale == scale
+                and page_pool.browser.is_connected()):
+            images = await page_pool.render(shell, body_html, output_image_paths, has_math, image_type)
+        elif browser is not None and browser.is_connected():
+            images = await _render_html_with_browser(
+                browser, full_html, output_image_paths, scale, has_math, image_type, width
+            )
+        else:
+            # 未提供常驻浏览器时，临时启动一个
+            async with async_playwright() as p:
+                logger.info("启动Playwright浏览器...")
+                temp_browser = await p.chromium.launch(args=_CHROMIUM_ARGS)
+                try:
+                    images = await _render_html_with_browser(
+                        temp_browser, full_html, output_image_paths, scale, has_math, image_type, width
+                    )
+                finally:
+                    await temp_browser.close()
+        logger.info(f"Markdown 图片已生成: {len(images)} 张")
+        return images
+    except Exception as e:
+        logger.error(f"Playwright转换过程中发生错误: {e}")
+        import traceback
+        logger.error(f"Playwright错误堆栈:\n{traceback.format_exc()}")
+        raise  # 重新抛出异常以便上层捕获
+
+
+# 公式预处理的合并正则，块级 $$...$$ 排在行内 $...$ 之前，避免被拆成两个行内公式
+_MATH_PREPROCESS_RE = re.compile(
+    r'\$\$([\s\S]*?)\$\$'    # 块级 $$...$$
+    r'|\$([^$]+)\$'           # 行内 $...$
+    r'|\\\((.+?)\\\)'        # 行内 \(...\)
+    r'|\\\[([\s\S]+?)\\\]'   # 块级 \[...\]
+)
+
+
+def _math_replacement(match) -> str:
+    """把匹配到的公式包装为 KaTeX 可识别的行内或块级元素"""
+    block = match.group(1) if match.group(1) is not None else match.group(4)
+    if block is not None:
+        return f'<div class="math-block">\\[{block}\\]</div>'
+    inline = match.group(2) if match.group(2) is not None else match.group(3)
+    return f'<span class="math-inline">\\({inline}\\)</span>'
+
+
+# 公式预处理时原样保留的部分：代码、脚本、样式元素整体，以及其余所有标签本身
+_MATH_SKIP_RE = re.compile(r'<(pre|code|script|style)\b[\s\S]*?</\1\s*>|<[^>]*>', re.IGNORECASE)
+
+
+def preprocess_math_formulas(html_content: str) -> str:
+    """
+    预处理数学公式，确保 KaTeX 能正确渲染
+    直接在 HTML 字符串上替换标签之间的文本，代码中的 $ 不会被当作公式
+    """
+    if '$' not in html_content and '\\' not in html_content:
+        return html_content
     
-    def escape_curly_braces(text):
-        """转义文本中的花括号，防止在格式化时被解析"""
-        return text.replace('{', '{{').replace('}', '}}')
+    parts = []
+    last_end = 0
+    for match in _MATH_SKIP_RE.finditer(html_content):
+        parts.append(_MATH_PREPROCESS_RE.sub(_math_replacement, html_content[last_end:match.start()]))
+        parts.append(match.group(0))
+        last_end = match.end()
+    parts.append(_MATH_PREPROCESS_RE.sub(_math_replacement, html_content[last_end:]))
+    return ''.join(parts)
+
+
+# 注入给 LLM 的 <md> 标签使用说明，分别对应开启和关闭自动检测的情况
+_AUTO_DETECT_PROMPT = """
+            当你需要发送包含复杂格式（如表格、数学公式、LaTeX等）的内容时，请使用 <md> 和 </md> 标签包裹需要转换为图片的Markdown内容。代码块不用加标签，会单独处理。
+            例如：
+            <md>
+            $$E=mc^2$$
+            </md>
+            <md>
+            \(a_1, a_2, \ldots, a_n\)
+            </md>
+            <md>
+            \[
+                \left( \sum_{i=1}^{n} a_i b_i \right)^2 \leq \left( \sum_{i=1}^{n} a_i^2 \right) \left( \sum_{i=1}^{n} b_i^2 \right)
+            \]
+            </md>
+            <md>
+            \(\mathbf{a} = (a_1, a_2, \ldots, a_n)\) 和 \(\mathbf{b} = (b_1, b_2, \ldots, b_n)\)
+            </md>
+            """
+
+_MD_TAG_PROMPT = """
+当你需要发送包含复杂格式（如代码块、表格、数学公式、LaTeX等）的内容时，请使用 <md> 和 </md> 标签包裹需要转换为图片的Markdown内容。
+
+例如：
+<md>
+# 复杂内容标题
+```python
+print("Hello World")
+```
+</md>
+<md>
+$$E=mc^2$$
+</md>
+<md>
+\(a_1, a_2, \ldots, a_n\)
+</md>
+<md>
+\[
+    \left( \sum_{i=1}^{n} a_i b_i \right)^2 \leq \left( \sum_{i=1}^{n} a_i^2 \right) \left( \sum_{i=1}^{n} b_i^2 \right)
+\]
+</md>
+<md>
+\(\mathbf{a} = (a_1, a_2, \ldots, a_n)\) 和 \(\mathbf{b} = (b_1, b_2, \ldots, b_n)\)
+</md>
+"""
 
-    width_style = f"width: {width}px; box-sizing: border-box;" if width else ""
-    
-    try:
-        html_template = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <title>Markdown Render</title>
-            <style>
-                * {{
-                    margin: 0;
-                    padding: 0;
-                    box-sizing: border-box;
-                }}
-                
-                body {{
-                    {width_style}
-                    font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Helvetica, Arial, sans-serif;
-                    padding: 20px;
-                    font-size: 16px;
-                    line-height: 1.6;
-                    background-color: #ffffff;
-                    color: #24292e;
-                }}
-                
-                .content-wrapper {{
-                    padding: 0;
-                }}
-
-                /* 数学公式样式 - 确保正确显示 */
-                .math-container {{
-                    margin: 10px 0;
-                    padding: 10px;
-                    text-align: center;
-                }}
-                
-                .math-inline {{
-                    display: inline;
-                    margin: 0 2px;
-                }}
-                
-                .math-block {{
-                    display: block;
-                    margin: 15px 0;
-                }}
-                
-                .math-error {{
-                    color: #dc2626;
-                    background: #fef2f2;
-                    border: 1px solid #fecaca;
-                    padding: 8px 12px;
-                    border-radius: 4px;
-                    font-family: monospace;
-                }}
-                
-                /* 代码块容器样式 */
-                .code-container {{
-                    position: relative;
-                    margin: 8px 0;
-                    border-radius: 4px;
-                    overflow: hidden;
-                    box-shadow: 0 1px 2px rgba(0, 0, 0, 0.1);
-                }}
-                
-                /* 代码标题栏 */
-                .code-header {{
-                    background: #2d3747;
-                    color: #e5e7eb;
-                    padding: 6px 12px;
-                    font-size: 12px;
-                    font-weight: 500;
-                    border-bottom: 1px solid #3e4c5e;
-                }}
-                
-                /* 代码内容区域 */
-                .code-content {{
-                    display: flex;
-                    background: #1e293b;
-                    margin: 0;
-                }}
-                
-                /* 行号样式 */
-                .line-numbers {{
-                    background: #1a2332;
-                    color: #64748b;
-                    padding: 8px 0;
-                    text-align: right;
-                    font-family: 'SFMono-Regular', Consolas, 'Liberation Mono', Menlo, monospace;
-                    font-size: {code_font_size}px;
-                    line-height: {line_height};
-                    user-select: none;
-                    border-right: 1px solid #334155;
-                    min-width: 40px;
-                    flex-shrink: 0;
-                    padding-right: 8px;
-                }}
-                
-                .line-number {{
-                    display: block;
-                    height: auto;
-                }}
-                
-                /* 代码区域 */
-                .code-wrapper {{
-                    flex: 1;
-                    overflow-x: auto;
-                    padding: 8px 12px;
-                }}
-                
-                .code {{
-                    font-family: 'SFMono-Regular', Consolas, 'Liberation Mono', Menlo, monospace;
-                    font-size: {code_font_size}px;
-                    line-height: {line_height};
-                    color: #e2e8f0;
-                    background: transparent;
-                    margin: 0;
-                    padding: 0;
-                    white-space: pre;
-                    tab-size: 4;
-                    -moz-tab-size: 4;
-                }}
-                
-                pre {{
-                    font-family: 'SFMono-Regular', Consolas, 'Liberation Mono', Menlo, monospace !important;
-                    white-space: pre !important;
-                    margin: 0 !important;
-                    padding: 0 !important;
-                    tab-size: 4 !important;
-                    -moz-tab-size: 4 !important;
-                    background: transparent !important;
-                }}
-                
-                code {{
-                    font-family: 'SFMono-Regular', Consolas, 'Liberation Mono', Menlo, monospace !important;
-                    white-space: pre !important;
-                    tab-size: 4 !important;
-                    -moz-tab-size: 4 !important;
-                    background: transparent !important;
-                    font-size: {code_font_size}px !important;
-                    line-height: {line_height} !important;
-                }}
-                
-                .hljs {{
-                    font-family: 'SFMono-Regular', Consolas, 'Liberation Mono', Menlo, monospace !important;
-                    white-space: pre !important;
-                    background: transparent !important;
-                    padding: 0 !important;
-                    margin: 0 !important;
-                    display: block !important;
-                    tab-size: 4 !important;
-                    -moz-tab-size: 4 !important;
-                    font-size: {code_font_size}px !important;
-                    line-height: {line_height} !important;
-                }}
-                
-                p {{ margin: 8px 0; }}
-                h1, h2, h3, h4, h5, h6 {{ margin: 12px 0 6px 0; }}
-                ul, ol {{ margin: 6px 0; padding-left: 24px; }}
-                li {{ margin: 2px 0; }}
-                blockquote {{ border-left: 2px solid #dfe2e5; padding-left: 12px; margin: 6px 0; color: #6a737d; }}
-                table {{ border-collapse: collapse; width: 100%; margin: 8px 0; font-size: 12px; }}
-                th, td {{ border: 1px solid #dfe2e5; padding: 4px 8px; text-align: left; }}
-                th {{ background-color: #f6f8fa; font-weight: 600; }}
-            </style>
-            
-            <!-- 使用 KaTeX - 更快速可靠的数学公式渲染 -->
-            <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.css">
-            <script src="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.js"></script>
-            <script src="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/contrib/auto-render.min.js"></script>
-            
-            <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/styles/github-dark.min.css">
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/highlight.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/python.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/javascript.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/java.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/cpp.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/c.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/html.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/css.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/sql.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/bash.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/json.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/xml.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/yaml.min.js"></script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/languages/markdown.min.js"></script>
-            
-            <script>
-                // 高亮代码块
-                document.addEventListener('DOMContentLoaded', function() {{
-                    hljs.highlightAll();
-                    
-                    // KaTeX 数学公式渲染
-                    renderMathInElement(document.body, {{
-                        delimiters: [
-                            {{left: '$$', right: '$$', display: true}},
-                            {{left: '$', right: '$', display: false}},
-                            {{left: '\\\\(', right: '\\\\)', display: false}},
-                            {{left: '\\\\[', right: '\\\\]', display: true}}
-                        ],
-                        throwOnError: false,
-                        errorColor: '#cc0000',
-                        macros: {{
-                            "\\RR": "\\\\mathbb{{R}}",
-                            "\\CC": "\\\\mathbb{{C}}", 
-                            "\\QQ": "\\\\mathbb{{Q}}",
-                            "\\ZZ": "\\\\mathbb{{Z}}",
-                            "\\NN": "\\\\mathbb{{N}}",
-                            "\\bm": "\\\\boldsymbol{{#1}}",
-                            "\\abs": ["\\\\left|#1\\\\right|", 1],
-                            "\\norm": ["\\\\left\\\\|#1\\\\right\\\\|", 1]
-                        }}
-                    }});
-                    
-                    // 标记渲染完成
-                    window.mathRendered = true;
-                }});
-            </script>
-        </head>
-        <body>
-            <div class="content-wrapper">
-                {content}
-            </div>
-        </body>
-        </html>
-        """
+# 代码语言到文件扩展名的映射
+_LANG_EXT = {
+    'python': 'py', 'py': 'py', 'javascript': 'js', 'js': 'js', 'java': 'java',
+    'cpp': 'cpp', 'c++': 'cpp', 'c': 'c', 'html': 'html', 'css': 'css', 'sql': 'sql',
+    'bash': 'sh', 'shell': 'sh', 'sh': 'sh', 'php': 'php', 'ruby': 'rb',
+    'go': 'go', 'rust': 'rs', 'typescript': 'ts', 'ts': 'ts', 'json': 'json',
+    'xml': 'xml', 'yaml': 'yml', 'yml': 'yml', 'markdown': 'md', 'md': 'md', 'text': 'txt'
+}
 
-        # 第一步：Markdown -> HTML
-        html_content = mistune.html(md_text)
-        
-        # 第二步：预处理数学公式
-        processed_html = preprocess_math_formulas(html_content)
-        
-        # 第三步：Python预处理代码块，加上行号
-        processed_html = process_code_blocks_in_html(processed_html)
-        
-        # 第四步：转义花括号
-        processed_html = escape_curly_braces(processed_html)
-        
-        # 第五步：使用安全的格式化生成完整HTML
-        full_html = safe_format(
-            html_template,
-            content=processed_html,
-            width_style=width_style,
-            code_font_size=code_font_size,
-            line_height=line_height
-        )
+# 每行行首的空白（不跨行）
+_LEADING_WS_RE = re.compile(r'^[^\S\n]+', re.MULTILINE)
+# 长度不是4的倍数的行首空白，不含制表符时只有这种缩进需要改写
+_UNALIGNED_INDENT_RE = re.compile(r'^(?:[^\S\n]{4})*[^\S\n]{1,3}(?![^\S\n])', re.MULTILINE)
 
 
-        async with async_playwright() as p:
-            logger.info("启动Playwright浏览器...")
-            browser = await p.chromium.launch()
-            context = await browser.new_context(device_scale_factor=scale)
-            page = await context.new_page()
+def _indent_replacement(match) -> str:
+    """制表符按4个空格计，纯空格缩进向上取整到4的倍数"""
+    indent = match.group()
+    tab_count = indent.count('\t')
+    if tab_count:
+        return ' ' * (len(indent) + 3 * tab_count)
+    if len(indent) & 3:
+        return ' ' * ((len(indent) + 3) & ~3)
+    return indent
 
-            await page.set_content(full_html, wait_until="domcontentloaded")
 
-            try:
-                # 等待高亮完成
-                await page.wait_for_function(
-                    "document.querySelectorAll('.hljs').length > 0 || document.querySelectorAll('pre code').length === 0",
-                    timeout=5000
-                )
-                
-                # 等待 KaTeX 渲染完成
-                await page.wait_for_function(
-                    "window.mathRendered === true",
-                    timeout=10000
-                )
-                
-                # 额外等待确保所有内容渲染完成
-                await page.wait_for_timeout(1000)
-                
-                # 检查数学公式是否渲染成功
-                math_elements = await page.query_selector_all('.katex, .katex-display')
-                if math_elements:
-                    logger.info(f"检测到 {len(math_elements)} 个数学公式元素")
-                else:
-                    logger.warning("未检测到数学公式元素，可能渲染失败")
-                
-            except Exception as e:
-                logger.warning(f"渲染警告: {e}")
-                # 即使有警告也继续，可能部分内容已经渲染完成
-
-            # 截图
-            content_element = await page.query_selector('.content-wrapper')
-            if content_element:
-                bounding_box = await content_element.bounding_box()
-                if bounding_box:
-                    await page.screenshot(
-                        path=output_image_path,
-                        clip={
-                            'x': bounding_box['x'],
-                            'y': bounding_box['y'],
-                            'width': bounding_box['width'],
-                            'height': bounding_box['height']
-                        }
-                    )
-                else:
-                    await page.screenshot(path=output_image_path, full_page=True)
+# /test_code 命令使用的代码示例
+_TEST_CODE_MD = '''```python
+    def hello_world():
+        """这是一个测试函数"""
+        for i in range(10):
+            if i % 2 == 0:
+                print(f"偶数: {i}")
             else:
-                await page.screenshot(path=output_image_path, full_page=True)
-                
-            await browser.close()
-            logger.info(f"Markdown 图片已生成: {output_image_path}")
-    except Exception as e:
-        logger.error(f"Playwright转换过程中发生错误: {e}")
-        import traceback
-        logger.error(f"Playwright错误堆栈:\n{traceback.format_exc()}")
-        raise  # 重新抛出异常以便上层捕获
-
+                print(f"奇数: {i}")
+        
+        # 返回结果
+        return "测试完成"
 
-def preprocess_math_formulas(html_content: str) -> str:
-    """
-    预处理数学公式，确保 KaTeX 能正确渲染
-    """
-    import re
-    from bs4 import BeautifulSoup
-    
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # 处理行内数学公式 $...$
-    inline_pattern = re.compile(r'\$([^$]+)\$')
-    text_nodes = soup.find_all(text=True)
-    
-    for text_node in text_nodes:
-        if text_node.parent and text_node.parent.name in ['script', 'style']:
-            continue
-            
-        if inline_pattern.search(text_node):
-            new_text = inline_pattern.sub(
-                r'<span class="math-inline">\\(\1\\)</span>', 
-                text_node
-            )
-            new_soup = BeautifulSoup(new_text, 'html.parser')
-            text_node.replace_with(new_soup)
-    
-    # 处理块级数学公式 $$...$$
-    block_pattern = re.compile(r'\$\$(.*?)\$\$', re.DOTALL)
-    text_nodes = soup.find_all(text=True)
-    
-    for text_node in text_nodes:
-        if text_node.parent and text_node.parent.name in ['script', 'style']:
-            continue
-            
-        if block_pattern.search(text_node):
-            new_text = block_pattern.sub(
-                r'<div class="math-block">\\[\1\\]</div>', 
-                text_node
-            )
-            new_soup = BeautifulSoup(new_text, 'html.parser')
-            text_node.replace_with(new_soup)
-    
-    # 处理 LaTeX 环境 \[ ... \] 和 \( ... \)
-    latex_inline_pattern = re.compile(r'\\\((.+?)\\\)')
-    latex_block_pattern = re.compile(r'\\\[(.+?)\\\]', re.DOTALL)
-    
-    text_nodes = soup.find_all(text=True)
-    for text_node in text_nodes:
-        if text_node.parent and text_node.parent.name in ['script', 'style']:
-            continue
-            
-        # 处理行内 \( ... \)
-        if latex_inline_pattern.search(text_node):
-            new_text = latex_inline_pattern.sub(
-                r'<span class="math-inline">\\(\1\\)</span>',
-                text_node
-            )
-            new_soup = BeautifulSoup(new_text, 'html.parser')
-            text_node.replace_with(new_soup)
+    class TestClass:
+        def __init__(self, name):
+            self.name = name
         
-        # 处理块级 \[ ... \]
-        if latex_block_pattern.search(text_node):
-            new_text = latex_block_pattern.sub(
-                r'<div class="math-block">\\[\1\\]</div>',
-                text_node
-            )
-            new_soup = BeautifulSoup(new_text, 'html.parser')
-            text_node.replace_with(new_soup)
-    
-    return str(soup)
+        def greet(self):
+            return f"Hello, {self.name}!"
+    ```'''
 
 
 @register(
@@ -674,20 +1261,66 @@ class SmartMarkdownConverterPlugin(Star):
         self.DATA_DIR = os.path.normpath(StarTools.get_data_dir())
         self.IMAGE_CACHE_DIR = os.path.join(self.DATA_DIR, "md2img_cache")
         self.FILE_CACHE_DIR = os.path.join(self.DATA_DIR, "file_cache")
+        self.ASSET_CACHE_DIR = os.path.join(self.DATA_DIR, "asset_cache")
+        # 预先拼好目录前缀，单次路径构造只需一次字符串格式化
+        self._image_cache_prefix = self.IMAGE_CACHE_DIR + os.sep
         self.detector = MarkdownComplexityDetector()
+        # 常驻的 Playwright 实例与浏览器，避免每次渲染都冷启动 Chromium
+        self._playwright = None
+        self._browser = None
+        self._browser_lock = asyncio.Lock()
+        self._page_pool = None
+        self._page_pool_size = 2
+        # 待合并的渲染请求，同一轮提交的请求在一个页面中一次渲染
+        self._render_scale = 2
+        self._render_width = 600
+        self._pending_renders = []
+        self._render_flush_task = None
+        # 所有尚未结束的合并渲染任务（包括已开始渲染的），停止插件时统一取消
+        self._flush_tasks = set()
+        self._background_tasks = set()
+        self._cache_sweep_task = None
+        # 插件停止后置位，之后不再启动浏览器
+        self._closed = False
+        # 最近生成的图片字节，按缓存键做 LRU
+        self._image_memory_cache = OrderedDict()
+        self._image_memory_cache_bytes = 0
+        # 正在进行中的渲染，按缓存键共享，同一内容同时只渲染一次
+        self._inflight_renders = {}
         global code_font_size, line_height
         # 从 config 参数获取用户配置
         self.config = config
         code_font_size = self.get_config_value('code_font_size', 13)
         line_height = self.get_config_value('line_height', 1.5)
+        self._image_ext = 'png' if self.get_config_value('image_format', 'jpg') == 'png' else 'jpg'
+        self._image_type = 'png' if self._image_ext == 'png' else 'jpeg'
+        # 合并渲染的等待窗口，窗口内提交的渲染请求合并为一次页面渲染
+        self._render_wait_ms = self.get_config_value('render_wait_ms', 80)
+        # 缓存消息处理路径上用到的配置项，避免每条消息反复查询
+        self._auto_detect = self.get_config_value('auto_detect', True)
+        self._min_complexity_score = self.get_config_value('min_complexity_score', 2)
+        self._respect_md_tags = self.get_config_value('respect_md_tags', True)
+        self._separate_code = self.get_config_value('separate_code_blocks', True)
+        self._separate_math = self.get_config_value('separate_math_blocks', False)
+        self._render_code = self.get_config_value('render_code_as_image', True)
+        self._send_code_file = self.get_config_value('send_code_as_file', False)
+        self._code_file_threshold = self.get_config_value('code_file_threshold', 10)
+        self._render_math = self.get_config_value('render_math_as_image', True)
+        self._debug_mode = self.get_config_value('is_debug_mode', False)
+        self._supported_languages = self.get_config_value(
+            'supported_code_languages', _DEFAULT_SUPPORTED_LANGUAGES)
+        self._supported_languages_lower = frozenset(
+            lang.lower() for lang in self._supported_languages)
         logger.info(f"加载用户配置: {self.config}")
 
     async def initialize(self):
         """初始化插件"""
         try:
-            os.makedirs(self.IMAGE_CACHE_DIR, exist_ok=True)
-            os.makedirs(self.FILE_CACHE_DIR, exist_ok=True)
-            logger.info("正在检查并安装 Playwright 浏览器依赖...")
+            await asyncio.to_thread(os.makedirs, self.IMAGE_CACHE_DIR, exist_ok=True)
+            await asyncio.to_thread(os.makedirs, self.FILE_CACHE_DIR, exist_ok=True)
+            await asyncio.to_thread(self._sweep_caches)
+            if self._cache_sweep_task is None:
+                self._cache_sweep_task = asyncio.create_task(self._cache_sweep_loop())
             
             async def run_playwright_command(command: list, description: str):
                 process = await asyncio.create_subprocess_exec(
@@ -710,23 +1343,136 @@ class SmartMarkdownConverterPlugin(Star):
                         logger.info(f"Playwright {description} 已是最新。")
                     return True
 
-            # 安装浏览器和依赖
-            import sys
-            install_browser_cmd = [sys.executable, "-m", "playwright", "install", "chromium"]
-            await run_playwright_command(install_browser_cmd, "Chromium 浏览器")
-            
-            install_deps_cmd = [sys.executable, "-m", "playwright", "install-deps"]
-            await run_playwright_command(install_deps_cmd, "系统依赖")
+            # 同一 Playwright 版本只安装一次，安装成功后写入标记文件
+            sentinel_path = os.path.join(
+                self.DATA_DIR, f".playwright_installed_{_playwright_version()}"
+            )
+            # install-deps 通常需要 root 权限，无论成功与否都只尝试一次
+            deps_sentinel_path = os.path.join(self.DATA_DIR, ".playwright_deps_attempted")
+            if await asyncio.to_thread(os.path.exists, sentinel_path):
+                logger.info("Playwright 浏览器已安装，跳过安装步骤")
+            else:
+                logger.info("正在检查并安装 Playwright 浏览器依赖...")
+                # 安装浏览器和依赖
+                import sys
+                install_browser_cmd = [sys.executable, "-m", "playwright", "install", "chromium"]
+                browser_installed = await run_playwright_command(install_browser_cmd, "Chromium 浏览器")
+                
+                if not await asyncio.to_thread(os.path.exists, deps_sentinel_path):
+                    install_deps_cmd = [sys.executable, "-m", "playwright", "install-deps"]
+                    await run_playwright_command(install_deps_cmd, "系统依赖")
+                    await asyncio.to_thread(_write_file_atomic, deps_sentinel_path, b"")
+
+                if browser_installed:
+                    await asyncio.to_thread(_write_file_atomic, sentinel_path, b"")
+
+            if await self._get_browser() is None:
+                # 浏览器文件可能已被清理，删除标记以便下次启动时重新安装
+                await asyncio.to_thread(_remove_if_exists, sentinel_path)
+            await self._get_page_pool()
 
             logger.info("智能 Markdown 转图片插件已初始化")
 
         except Exception as e:
             logger.error(f"插件初始化过程中发生错误: {e}")
 
+    def _sweep_caches(self):
+        """清理图片缓存和代码文件缓存"""
+        for directory, max_bytes, max_age in (
+            (self.IMAGE_CACHE_DIR, _IMAGE_CACHE_MAX_BYTES, _IMAGE_CACHE_MAX_AGE),
+            (self.FILE_CACHE_DIR, None, _FILE_CACHE_MAX_AGE),
+        ):
+            try:
+                removed, total_size = _prune_dir(directory, max_bytes, max_age)
+                if removed:
+                    logger.info(f"缓存目录 {directory} 已清理 {removed} 个文件，当前大小: {total_size} bytes")
+            except Exception as e:
+                logger.error(f"清理缓存目录 {directory} 失败: {e}")
+
+    async def _cache_sweep_loop(self):
+        """定期在后台线程中清理缓存目录"""
+        while True:
+            await asyncio.sleep(_CACHE_SWEEP_INTERVAL)
+            await asyncio.to_thread(self._sweep_caches)
+
     async def terminate(self):
         """插件停用时调用"""
+        self._closed = True
+        if self._cache_sweep_task is not None:
+            self._cache_sweep_task.cancel()
+            self._cache_sweep_task = None
+        
+        # 取消尚未完成的合并渲染，仍在队列中的请求直接失败
+        self._render_flush_task = None
+        flush_tasks = list(self._flush_tasks)
+        for flush_task in flush_tasks:
+            flush_task.cancel()
+        await asyncio.gather(*flush_tasks, return_exceptions=True)
+        pending = self._pending_renders
+        self._pending_renders = []
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("插件已停止，渲染请求已取消"))
+        
+        # 等待后台的缓存写入完成，再关闭浏览器
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        await self._close_browser()
         logger.info("智能 Markdown 转图片插件已停止")
 
+    async def _get_browser(self):
+        """获取常驻浏览器，未启动或已断开时重新启动"""
+        async with self._browser_lock:
+            # 插件停止后不再重新启动浏览器
+            if self._closed:
+                return None
+            if self._browser is not None and self._browser.is_connected():
+                return self._browser
+            try:
+                if self._playwright is None:
+                    self._playwright = await async_playwright().start()
+                logger.info("启动常驻Playwright浏览器...")
+                self._browser = await self._playwright.chromium.launch(args=_CHROMIUM_ARGS)
+            except Exception as e:
+                logger.error(f"启动Playwright浏览器失败: {e}")
+                self._browser = None
+            return self._browser
+
+    async def _get_page_pool(self):
+        """获取绑定当前常驻浏览器的页面池，浏览器重启后重新创建"""
+        browser = await self._get_browser()
+        if browser is None:
+            return None
+        async with self._browser_lock:
+            if self._page_pool is None or self._page_pool.browser is not browser:
+                pool = PagePool(browser, size=self._page_pool_size, scale=self._render_scale,
+                                asset_dir=self.ASSET_CACHE_DIR, width=self._render_width)
+                try:
+                    await pool.start()
+                except Exception as e:
+                    logger.error(f"创建Playwright页面池失败: {e}")
+                    await pool.close()
+                    return None
+                self._page_pool = pool
+            return self._page_pool
+
+    async def _close_browser(self):
+        """关闭常驻浏览器并停止 Playwright"""
+        async with self._browser_lock:
+            try:
+                if self._page_pool is not None:
+                    await self._page_pool.close()
+                if self._browser is not None:
+                    await self._browser.close()
+                if self._playwright is not None:
+                    await self._playwright.stop()
+            except Exception as e:
+                logger.error(f"关闭Playwright浏览器失败: {e}")
+            finally:
+                self._page_pool = None
+                self._browser = None
+                self._playwright = None
+
     def get_config_value(self, key: str, default=None):
         """获取配置值"""
         return self.config.get(key, default)
@@ -734,54 +1480,8 @@ class SmartMarkdownConverterPlugin(Star):
     @filter.on_llm_request()
     async def on_llm_req(self, event: AstrMessageEvent, req: ProviderRequest):
         """向 LLM 说明图片渲染功能的使用方式"""
-        auto_detect = self.get_config_value('auto_detect', True)
-        
-        if auto_detect:
-            instruction_prompt = """
-            当你需要发送包含复杂格式（如表格、数学公式、LaTeX等）的内容时，请使用 <md> 和 </md> 标签包裹需要转换为图片的Markdown内容。代码块不用加标签，会单独处理。
-            例如：
-            <md>
-            $$E=mc^2$$
-            </md>
-            <md>
-            \(a_1, a_2, \ldots, a_n\)
-            </md>
-            <md>
-            \[
-                \left( \sum_{i=1}^{n} a_i b_i \right)^2 \leq \left( \sum_{i=1}^{n} a_i^2 \right) \left( \sum_{i=1}^{n} b_i^2 \right)
-            \]
-            </md>
-            <md>
-            \(\mathbf{a} = (a_1, a_2, \ldots, a_n)\) 和 \(\mathbf{b} = (b_1, b_2, \ldots, b_n)\)
-            </md>
-            """
-        else:
-            instruction_prompt = """
-当你需要发送包含复杂格式（如代码块、表格、数学公式、LaTeX等）的内容时，请使用 <md> 和 </md> 标签包裹需要转换为图片的Markdown内容。
-
-例如：
-<md>
-# 复杂内容标题
-```python
-print("Hello World")
-```
-</md>
-<md>
-$$E=mc^2$$
-</md>
-<md>
-\(a_1, a_2, \ldots, a_n\)
-</md>
-<md>
-\[
-    \left( \sum_{i=1}^{n} a_i b_i \right)^2 \leq \left( \sum_{i=1}^{n} a_i^2 \right) \left( \sum_{i=1}^{n} b_i^2 \right)
-\]
-</md>
-<md>
-\(\mathbf{a} = (a_1, a_2, \ldots, a_n)\) 和 \(\mathbf{b} = (b_1, b_2, \ldots, b_n)\)
-</md>
-"""
-        if self.get_config_value("is_debug_mode", False):
+        instruction_prompt = _AUTO_DETECT_PROMPT if self._auto_detect else _MD_TAG_PROMPT
+        if self._debug_mode:
             logger.info(f"<DEBUG> LLM 请求说明: {instruction_prompt}")
 
         req.system_prompt += f"\n\n{instruction_prompt}"
@@ -796,14 +1496,38 @@ $$E=mc^2$$
         """在最终消息链生成阶段，智能处理Markdown内容"""
         result = event.get_result()
         chain = result.chain
-        if self.get_config_value("is_debug_mode", False):
+        if self._debug_mode:
             logger.info(f"<DEBUG> 处理前的消息链: {chain}")
         new_chain = []
         
+        async def collect(text: str) -> List:
+            components = [component async for component in self._smart_process_markdown(text)]
+            # 渲染任务在产出时已经开始，这里再统一等待结果，使同一段文本中的多个渲染并行进行
+            # 同时把相邻的文本组件合并为一个，减少消息段数量
+            merged = []
+            pending_texts = []
+            for component in components:
+                if isinstance(component, asyncio.Task):
+                    component = await component
+                if isinstance(component, Plain):
+                    pending_texts.append(component.text)
+                    continue
+                if pending_texts:
+                    merged.append(Plain("".join(pending_texts)))
+                    pending_texts = []
+                merged.append(component)
+            if pending_texts:
+                merged.append(Plain("".join(pending_texts)))
+            return merged
+        
+        # 并发处理所有文本段，使它们的渲染请求能合并到同一次页面渲染中
+        plain_results = iter(await asyncio.gather(*(
+            collect(item.text) for item in chain if isinstance(item, Plain)
+        )))
+        
         for item in chain:
             if isinstance(item, Plain):
-                components = await self._smart_process_markdown(item.text)
-                new_chain.extend(components)
+                new_chain.extend(next(plain_results))
             else:
                 new_chain.append(item)
                 
@@ -813,53 +1537,51 @@ $$E=mc^2$$
     async def on_config_command(self, event: AstrMessageEvent):
         """查看当前配置的命令"""
         try:
-            config_info = "📋 **智能Markdown转换插件当前配置**\n\n"
+            parts = ["📋 **智能Markdown转换插件当前配置**", ""]
+            append = parts.append
             
             # 基础配置
-            config_info += "**基础设置**\n"
-            auto_detect = self.get_config_value('auto_detect', True)
-            complexity_score = self.get_config_value('min_complexity_score', 2)
-            respect_md_tags = self.get_config_value('respect_md_tags', True)
-            separate_code = self.get_config_value('separate_code_blocks', True)
-            separate_math = self.get_config_value('separate_math_blocks', False)
+            auto_detect = self._auto_detect
+            complexity_score = self._min_complexity_score
+            respect_md_tags = self._respect_md_tags
+            separate_code = self._separate_code
+            separate_math = self._separate_math
             
-            config_info += f"• 自动检测: {'✅ 开启' if auto_detect else '❌ 关闭'}\n"
-            config_info += f"• 复杂度阈值: {complexity_score}\n"
-            config_info += f"• 尊重MD标签: {'✅ 开启' if respect_md_tags else '❌ 关闭'}\n"
-            config_info += f"• 分离代码块: {'✅ 开启' if separate_code else '❌ 关闭'}\n"
-            config_info += f"• 分离数学公式: {'✅ 开启' if separate_math else '❌ 关闭'}\n\n"
+            append("**基础设置**")
+            append(f"• 自动检测: {'✅ 开启' if auto_detect else '❌ 关闭'}")
+            append(f"• 复杂度阈值: {complexity_score}")
+            append(f"• 尊重MD标签: {'✅ 开启' if respect_md_tags else '❌ 关闭'}")
+            append(f"• 分离代码块: {'✅ 开启' if separate_code else '❌ 关闭'}")
+            append(f"• 分离数学公式: {'✅ 开启' if separate_math else '❌ 关闭'}")
+            append("")
             
             # 代码处理配置
-            config_info += "**代码处理设置**\n"
-            render_code = self.get_config_value('render_code_as_image', True)
-            send_file = self.get_config_value('send_code_as_file', False)
-            file_threshold = self.get_config_value('code_file_threshold', 10)
+            render_code = self._render_code
+            send_file = self._send_code_file
+            file_threshold = self._code_file_threshold
             
-            config_info += f"• 代码渲染为图片: {'✅ 开启' if render_code else '❌ 关闭'}\n"
-            config_info += f"• 长代码发送为文件: {'✅ 开启' if send_file else '❌ 关闭'}\n"
-            config_info += f"• 文件转换阈值: {file_threshold} 行\n\n"
+            append("**代码处理设置**")
+            append(f"• 代码渲染为图片: {'✅ 开启' if render_code else '❌ 关闭'}")
+            append(f"• 长代码发送为文件: {'✅ 开启' if send_file else '❌ 关闭'}")
+            append(f"• 文件转换阈值: {file_threshold} 行")
+            append("")
             
             # 数学公式处理配置
-            config_info += "**数学公式处理**\n"
-            render_math = self.get_config_value('render_math_as_image', True)
-            config_info += f"• 公式渲染为图片: {'✅ 开启' if render_math else '❌ 关闭'}\n\n"
+            render_math = self._render_math
+            
+            append("**数学公式处理**")
+            append(f"• 公式渲染为图片: {'✅ 开启' if render_math else '❌ 关闭'}")
+            append("")
             
             # 支持的语言列表
-            supported_langs = self.get_config_value('supported_code_languages', [
-                "python", "javascript", "java", "cpp", "c", 
-                "html", "css", "sql", "bash", "shell",
-                "php", "ruby", "go", "rust", "typescript",
-                "json", "xml", "yaml", "markdown"
-            ])
+            supported_langs = self._supported_languages
+            more = " 等" if len(supported_langs) > 8 else ""
             
-            config_info += f"**支持的文件语言**\n"
-            config_info += f"• 共 {len(supported_langs)} 种: {', '.join(supported_langs[:8])}"
-            if len(supported_langs) > 8:
-                config_info += f" 等\n"
-            else:
-                config_info += "\n"
+            append("**支持的文件语言**")
+            append(f"• 共 {len(supported_langs)} 种: {', '.join(supported_langs[:8])}{more}")
+            append("")
             
-            yield event.plain_result(config_info)
+            yield event.plain_result("\n".join(parts))
             
         except Exception as e:
             logger.error(f"获取配置信息失败: {e}")
@@ -869,39 +1591,25 @@ $$E=mc^2$$
     async def on_test_code(self, event: AstrMessageEvent):
         """测试代码渲染效果的命令"""
         try:
-            # 测试用的代码示例
-            test_code = '''```python
-    def hello_world():
-        """这是一个测试函数"""
-        for i in range(10):
-            if i % 2 == 0:
-                print(f"偶数: {i}")
-            else:
-                print(f"奇数: {i}")
-        
-        # 返回结果
-        return "测试完成"
-
-    class TestClass:
-        def __init__(self, name):
-            self.name = name
-        
-        def greet(self):
-            return f"Hello, {self.name}!"
-    ```'''
-
             # 生成测试图片
-            image_filename = f"test_code_{uuid.uuid4().hex[:8]}.png"
-            output_path = os.path.join(self.IMAGE_CACHE_DIR, image_filename)
+            image_filename = f"test_code_{os.urandom(4).hex()}.{self._image_ext}"
+            output_path = f"{self._image_cache_prefix}{image_filename}"
             
             await markdown_to_image_playwright(
-                md_text=test_code,
+                md_text=_TEST_CODE_MD,
                 output_image_path=output_path,
                 scale=2,
-                width=600
+                width=600,
+                page_pool=await self._get_page_pool()
             )
             
-            if os.path.exists(output_path):
+            # 一次 stat 同时确认文件存在且非空
+            try:
+                stat_result = await asyncio.to_thread(os.stat, output_path)
+            except FileNotFoundError:
+                stat_result = None
+            if stat_result is not None and stat_result.st_size > 0:
+                logger.info(f"测试图片生成成功 (大小: {stat_result.st_size} bytes)")
                 yield event.image_result(output_path)
             else:
                 yield event.plain_result("测试图片生成失败")
@@ -910,70 +1618,54 @@ $$E=mc^2$$
             logger.error(f"测试代码渲染失败: {e}")
             yield event.plain_result(f"测试失败: {e}")
 
-    async def _smart_process_markdown(self, text: str) -> List:
+    async def _smart_process_markdown(self, text: str) -> AsyncIterator:
         """
         智能处理Markdown文本，自动判断是否需要转换为图片
+        按顺序逐个产出消息组件，需要渲染的部分产出渲染任务，由调用方统一等待
         """
-        components = []
+        # 首先处理显式的<md>标签（如果启用），按匹配位置依次处理标签前的文本和标签内容
+        last_end = 0
+        if self._respect_md_tags:
+            for md_match in _MD_TAG_RE.finditer(text):
+                part = text[last_end:md_match.start()].strip()
+                if part:
+                    async for component in self._process_text_with_blocks(part):
+                        yield component
+                last_end = md_match.end()
 
-        # 首先处理显式的<md>标签（如果启用）
-        respect_md_tags = self.get_config_value('respect_md_tags', True)
-        if respect_md_tags:
-            pattern = r"(<md>.*?</md>)"
-            parts = re.split(pattern, text, flags=re.DOTALL)
+                md_content = md_match.group(1).strip()
+                if md_content:
+                    yield self._schedule_render(md_content, f"--- Markdown 渲染失败 ---\n{md_content}")
         else:
-            parts = [text]
-
-        for part in parts:
-            part = part.strip()
-            if not part:
-                continue
-                
-            # 处理显式的<md>标签
-            if part.startswith("<md>") and part.endswith("</md>"):
-                md_content = part[4:-5].strip()
+            # 不逐个识别标签，但整段文本恰好被<md>标签包裹时仍整体渲染
+            stripped = text.strip()
+            if stripped.startswith("<md>") and stripped.endswith("</md>"):
+                md_content = stripped[4:-5].strip()
                 if md_content:
-                    image_component = await self._convert_markdown_to_image(md_content)
-                    if image_component:
-                        components.append(image_component)
-                    else:
-                        components.append(Plain(f"--- Markdown 渲染失败 ---\n{md_content}"))
-            
-            # 处理普通文本
-            else:
-                processed_components = await self._process_text_with_blocks(part)
-                components.extend(processed_components)
-                
-        return components
+                    yield self._schedule_render(md_content, f"--- Markdown 渲染失败 ---\n{md_content}")
+                return
 
-    async def _process_text_with_blocks(self, text: str) -> List:
+        # 处理剩余的普通文本
+        part = text[last_end:].strip()
+        if part:
+            async for component in self._process_text_with_blocks(part):
+                yield component
+
+    async def _process_text_with_blocks(self, text: str) -> AsyncIterator:
         """处理文本，分离代码块和数学公式"""
-        components = []
-        
         # 检查是否启用代码块分离
-        separate_code = self.get_config_value('separate_code_blocks', True)
-        separate_math = self.get_config_value('separate_math_blocks', False)
+        separate_code = self._separate_code
+        separate_math = self._separate_math
         
         # 修复：即使不分离代码块和数学公式，也要正确处理文本
         if not separate_code and not separate_math:
             # 不分离块，直接处理整个文本
-            return await self._process_plain_text(text)
-        
-        # 提取代码块和数学公式
-        code_blocks = self.detector.extract_code_blocks(text) if separate_code else []
-        math_blocks = self.detector.extract_math_blocks(text) if separate_math else []
-        
-        # 将所有块合并并按位置排序
-        all_blocks = []
-        for block in code_blocks:
-            block['block_type'] = 'code'
-            all_blocks.append(block)
-        for block in math_blocks:
-            block['block_type'] = 'math'
-            all_blocks.append(block)
+            async for component in self._process_plain_text(text):
+                yield component
+            return
         
-        # 按位置排序
-        all_blocks.sort(key=lambda x: x['start'])
+        # 一次扫描提取代码块和数学公式，结果已按位置排序
+        all_blocks = self.detector.scan_blocks(text, code=separate_code, math=separate_math)
         
         if all_blocks:
             # 分割文本和块
@@ -983,16 +1675,16 @@ $$E=mc^2$$
                 if block['start'] > last_pos:
                     text_before = text[last_pos:block['start']]
                     if text_before.strip():
-                        text_components = await self._process_plain_text(text_before)
-                        components.extend(text_components)
+                        async for component in self._process_plain_text(text_before):
+                            yield component
                 
                 # 处理块
                 if block['block_type'] == 'code':
-                    code_components = await self._process_code_block(block)
-                    components.extend(code_components)
+                    block_components = self._process_code_block(block)
                 else:  # math
-                    math_components = await self._process_math_block(block)
-                    components.extend(math_components)
+                    block_components = self._process_math_block(block)
+                async for component in block_components:
+                    yield component
                 
                 last_pos = block['end']
             
@@ -1000,264 +1692,180 @@ $$E=mc^2$$
             if last_pos < len(text):
                 text_after = text[last_pos:]
                 if text_after.strip():
-                    text_components = await self._process_plain_text(text_after)
-                    components.extend(text_components)
+                    async for component in self._process_plain_text(text_after):
+                        yield component
         else:
             # 没有特殊块，直接处理文本
-            text_components = await self._process_plain_text(text)
-            components.extend(text_components)
-            
-        return components
+            async for component in self._process_plain_text(text):
+                yield component
 
-    async def _process_plain_text(self, text: str) -> List:
-        """处理纯文本（智能分离复杂部分和简单部分）"""
-        components = []
-        
+    def _should_render_text(self, text: str) -> bool:
+        """判断纯文本是否需要渲染（同步执行，长文本由调用方放到线程中）"""
         # 检查是否主要是链接内容
         if self.detector._only_contains_links(text):
             logger.info("检测到链接内容，保持为文本直接发送")
-            components.append(Plain(text))
-            return components
-        
-        # 如果自动检测关闭，直接返回文本
-        if not self.get_config_value('auto_detect', True):
-            components.append(Plain(text))
-            return components
-        
-        # 检查是否需要渲染
-        if not self.detector.needs_rendering(text, self.get_config_value('min_complexity_score', 2)):
-            components.append(Plain(text))
-            return components
+            return False
+        return self.detector.needs_rendering(text, self._min_complexity_score)
+
+    async def _process_plain_text(self, text: str) -> AsyncIterator:
+        """处理纯文本（智能分离复杂部分和简单部分）"""
+        # 如果自动检测关闭，直接返回文本，不必再做任何扫描
+        if not self._auto_detect:
+            yield Plain(text)
+            return
+        
+        # 检查是否需要渲染，长文本的链接检查和正则扫描整体放到线程中执行，避免阻塞事件循环
+        if len(text) > _DETECT_IN_THREAD_THRESHOLD:
+            needs_rendering = await asyncio.to_thread(self._should_render_text, text)
+        else:
+            needs_rendering = self._should_render_text(text)
+        if not needs_rendering:
+            yield Plain(text)
+            return
         
         logger.info("检测到复杂Markdown格式，尝试智能分离处理")
         
         # 尝试提取复杂部分并分别处理
-        processed_components = await self._extract_and_process_complex_parts(text)
-        if processed_components:
-            components.extend(processed_components)
-        else:
+        processed = False
+        async for component in self._extract_and_process_complex_parts(text):
+            processed = True
+            yield component
+        if not processed:
             # 如果分离失败，回退到整体转换
-            image_component = await self._convert_markdown_to_image(text)
-            if image_component:
-                components.append(image_component)
-            else:
-                components.append(Plain(text))
-                
-        return components
+            yield self._schedule_render(text, text)
 
-    async def _extract_and_process_complex_parts(self, text: str) -> List:
+    async def _extract_and_process_complex_parts(self, text: str) -> AsyncIterator:
         """提取并分别处理复杂部分"""
-        components = []
-        
-        # 使用正则表达式分割文本，识别复杂块
-        pattern = r'(```[\s\S]*?```|\$\$[\s\S]*?\$\$|\$[^$]+\$|`[^`]+`|\|.*\|.*\n\|.*---.*\|.*\n(?:\|.*\|.*\n)*)'
-        parts = re.split(pattern, text)
-        
+        # 一次扫描同时完成分割和分类，按匹配到的命名分组分派处理
         current_simple_text = ""
-        
-        for part in parts:
-            if not part:
-                continue
-                
-            # 检查是否为复杂块
-            is_complex = (
-                part.startswith('```') and part.endswith('```') or  # 代码块
-                part.startswith('$$') and part.endswith('$$') or    # 数学公式块
-                part.startswith('$') and part.endswith('$') or      # 行内数学公式
-                part.startswith('`') and part.endswith('`') or      # 行内代码
-                re.match(r'^\|.*\|.*\n\|.*---.*\|.*\n(?:\|.*\|.*\n)*$', part)  # 表格
-            )
+        pos = 0
+        
+        for match in _COMPLEX_SCANNER_RE.finditer(text):
+            # 累积复杂块之前的简单文本，非空时先行发送
+            current_simple_text += text[pos:match.start()]
+            if current_simple_text.strip():
+                yield Plain(current_simple_text)
+                current_simple_text = ""
+            pos = match.end()
             
-            if is_complex:
-                # 先处理累积的简单文本
-                if current_simple_text.strip():
-                    components.append(Plain(current_simple_text))
-                    current_simple_text = ""
+            part = match.group()
+            kind = match.lastgroup
+            if kind == 'fence':
+                # 代码块，语言和内容直接取自扫描结果
+                language = match.group('lang') or 'text'
+                content = match.group('code').strip()
                 
-                # 处理复杂块
-                if part.startswith('```') and part.endswith('```'):
-                    # 代码块
-                    code_match = re.match(r'```(\w+)?\n?(.*?)\n?```', part, re.DOTALL)
-                    if code_match:
-                        language = code_match.group(1) or 'text'
-                        content = code_match.group(2).strip()
-                        
-                        # 关键修改：规范化缩进
-                        normalized_content = self._normalize_code_indentation(content)
-                        
-                        code_block = {
-                            'language': language,
-                            'content': normalized_content,  # 使用规范化后的内容
-                            'full_match': part,
-                            'start': 0,
-                            'end': len(part)
-                        }
-                        code_components = await self._process_code_block(code_block)
-                        components.extend(code_components)
-                    else:
-                        components.append(Plain(part))
-                elif part.startswith('$$') and part.endswith('$$'):
-                    # 数学公式块
-                    math_content = part[2:-2].strip()
-                    math_block = {
-                        'type': 'block',
-                        'content': math_content,
-                        'full_match': part,
-                        'start': 0,
-                        'end': len(part)
-                    }
-                    math_components = await self._process_math_block(math_block)
-                    components.extend(math_components)
-                elif part.startswith('$') and part.endswith('$') and len(part) > 2:
-                    # 行内数学公式
-                    math_content = part[1:-1].strip()
-                    math_block = {
-                        'type': 'inline',
-                        'content': math_content,
-                        'full_match': part,
-                        'start': 0,
-                        'end': len(part)
-                    }
-                    math_components = await self._process_math_block(math_block)
-                    components.extend(math_components)
-                elif part.startswith('`') and part.endswith('`') and len(part) > 2:
-                    # 行内代码 - 保持为文本
-                    components.append(Plain(part))
-                elif re.match(r'^\|.*\|.*\n\|.*---.*\|.*\n(?:\|.*\|.*\n)*$', part):
-                    # 表格 - 转换为图片
-                    image_component = await self._convert_markdown_to_image(part)
-                    if image_component:
-                        components.append(image_component)
-                    else:
-                        components.append(Plain(part))
-                else:
-                    components.append(Plain(part))
+                # 关键修改：规范化缩进
+                normalized_content = self._normalize_code_indentation(content)
+                
+                code_block = {
+                    'language': language,
+                    'content': normalized_content,  # 使用规范化后的内容
+                    'normalized': True,  # 已规范化，后续处理不再重复
+                    'full_match': part,
+                    'start': 0,
+                    'end': len(part)
+                }
+                async for component in self._process_code_block(code_block):
+                    yield component
+            elif kind == 'mathblk' or kind == 'mathinl':
+                # 数学公式块 / 行内数学公式
+                math_block = {
+                    'type': 'block' if kind == 'mathblk' else 'inline',
+                    'content': match.group('blk' if kind == 'mathblk' else 'inl').strip(),
+                    'full_match': part,
+                    'start': 0,
+                    'end': len(part)
+                }
+                async for component in self._process_math_block(math_block):
+                    yield component
+            elif kind == 'inline':
+                # 行内代码 - 保持为文本
+                yield Plain(part)
             else:
-                # 累积简单文本
-                current_simple_text += part
+                # 表格 - 转换为图片
+                yield self._schedule_render(part, part)
         
         # 处理最后剩余的简单文本
+        current_simple_text += text[pos:]
         if current_simple_text.strip():
-            components.append(Plain(current_simple_text))
-        
-        return components
+            yield Plain(current_simple_text)
 
-    async def _process_code_block(self, code_block: Dict) -> List:
+    async def _process_code_block(self, code_block: Dict) -> AsyncIterator:
         """处理代码块"""
-        render_code = self.get_config_value('render_code_as_image', True)
-        send_file = self.get_config_value('send_code_as_file', False)
-        file_threshold = self.get_config_value('code_file_threshold', 10)
+        render_code = self._render_code
+        send_file = self._send_code_file
+        file_threshold = self._code_file_threshold
         
         language = code_block['language']
         content = code_block['content']
-        supported_languages = self.get_config_value('supported_code_languages', [
-            "python", "javascript", "java", "cpp", "c", 
-            "html", "css", "sql", "bash", "shell",
-            "php", "ruby", "go", "rust", "typescript",
-            "json", "xml", "yaml", "markdown"
-        ])
-        
-        components = []
         
         # 计算代码行数
-        line_count = len(content.split('\n'))
+        line_count = content.count('\n') + 1
         logger.info(f"代码块处理: 语言={language}, 行数={line_count}, 阈值={file_threshold}")
         
         # 检查是否应该发送为文件
         should_send_file = (send_file and 
-                        language.lower() in [lang.lower() for lang in supported_languages] and 
+                        language.lower() in self._supported_languages_lower and 
                         line_count > file_threshold)
         
         logger.info(f"是否发送文件: {should_send_file}")
         
         # 关键修改：确保代码缩进为4个空格
         # 将制表符转换为4个空格，并确保缩进一致性
-        normalized_content = self._normalize_code_indentation(content)
+        if code_block.get('normalized'):
+            normalized_content = content
+        else:
+            normalized_content = self._normalize_code_indentation(content)
         
         if should_send_file:
             # 发送为文件
             file_component = await self._create_code_file(normalized_content, language)
             if file_component:
-                components.append(file_component)
-                # 添加简短的代码预览
-                preview_lines = normalized_content.split('\n')[:5]  # 显示前5行作为预览
-                preview = '\n'.join(preview_lines)
+                yield file_component
+                # 添加简短的代码预览：前5行，只定位第5个换行，不切分整段代码
+                preview_end = -1
+                for _ in range(5):
+                    preview_end = normalized_content.find('\n', preview_end + 1)
+                    if preview_end == -1:
+                        break
+                preview = normalized_content if preview_end == -1 else normalized_content[:preview_end]
+                parts = [f"```{language}", preview]
                 if line_count > 5:
-                    preview += f"\n... (共{line_count}行，完整代码已发送为文件)"
-                components.append(Plain(f"```{language}\n{preview}\n```"))
+                    parts.append(f"... (共{line_count}行，完整代码已发送为文件)")
+                parts.append("```")
+                yield Plain("\n".join(parts))
             else:
                 # 文件创建失败，回退到渲染或直接发送
                 if render_code:
                     md_content = f"```{language}\n{normalized_content}\n```"
-                    image_component = await self._convert_markdown_to_image(md_content)
-                    if image_component:
-                        components.append(image_component)
-                    else:
-                        components.append(Plain(f"```{language}\n{normalized_content}\n```"))
+                    yield self._schedule_render(md_content, md_content)
                 else:
-                    components.append(Plain(f"```{language}\n{normalized_content}\n```"))
+                    yield Plain(f"```{language}\n{normalized_content}\n```")
         elif render_code:
             # 渲染为图片
             md_content = f"```{language}\n{normalized_content}\n```"
-            image_component = await self._convert_markdown_to_image(md_content)
-            if image_component:
-                components.append(image_component)
-            else:
-                components.append(Plain(f"```{language}\n{normalized_content}\n```"))
+            yield self._schedule_render(md_content, md_content)
         else:
             # 直接发送代码文本
-            components.append(Plain(f"```{language}\n{normalized_content}\n```"))
-        
-        return components
+            yield Plain(f"```{language}\n{normalized_content}\n```")
 
     def _normalize_code_indentation(self, code_content: str) -> str:
         """
         规范化代码缩进，确保使用4个空格
         """
-        lines = code_content.split('\n')
-        normalized_lines = []
-        
-        for line in lines:
-            # 计算前导空格或制表符的数量
-            leading_whitespace = len(line) - len(line.lstrip())
-            
-            if leading_whitespace > 0:
-                # 获取前导空白字符
-                leading_chars = line[:leading_whitespace]
-                
-                # 如果是制表符，转换为4个空格
-                if '\t' in leading_chars:
-                    # 计算制表符等效的空格数（每个制表符=4个空格）
-                    tab_count = leading_chars.count('\t')
-                    space_count = len(leading_chars) - tab_count
-                    total_spaces = tab_count * 4 + space_count
-                    
-                    # 使用4个空格替换
-                    normalized_line = ' ' * total_spaces + line[leading_whitespace:]
-                else:
-                    # 已经是空格，确保是4的倍数
-                    space_count = len(leading_chars)
-                    # 如果不是4的倍数，向上取整到最近的4的倍数
-                    if space_count % 4 != 0:
-                        normalized_space_count = ((space_count + 3) // 4) * 4
-                        normalized_line = ' ' * normalized_space_count + line[leading_whitespace:]
-                    else:
-                        normalized_line = line
-            else:
-                normalized_line = line
-                
-            normalized_lines.append(normalized_line)
-        
-        return '\n'.join(normalized_lines)
+        # 常见情况：没有制表符且缩进都已是4的倍数，原样返回，不做任何复制
+        if '\t' not in code_content and not _UNALIGNED_INDENT_RE.search(code_content):
+            return code_content
+        # 只对行首空白做一次正则替换，行内内容不逐行切分重建
+        return _LEADING_WS_RE.sub(_indent_replacement, code_content)
 
-    async def _process_math_block(self, math_block: Dict) -> List:
+    async def _process_math_block(self, math_block: Dict) -> AsyncIterator:
         """处理数学公式块"""
-        render_math = self.get_config_value('render_math_as_image', True)
+        render_math = self._render_math
         math_type = math_block['type']
         content = math_block['content']
         
-        components = []
-        
         if render_math:
             # 渲染为图片
             if math_type == 'inline':
@@ -1265,38 +1873,24 @@ $$E=mc^2$$
             else:
                 md_content = f"$$\n{content}\n$$"
                 
-            image_component = await self._convert_markdown_to_image(md_content)
-            if image_component:
-                components.append(image_component)
-            else:
-                components.append(Plain(md_content))
+            yield self._schedule_render(md_content, md_content)
         else:
             # 保持原样
             if math_type == 'inline':
-                components.append(Plain(f"${content}$"))
+                yield Plain(f"${content}$")
             else:
-                components.append(Plain(f"$$\n{content}\n$$"))
-        
-        return components
+                yield Plain(f"$$\n{content}\n$$")
 
     async def _create_code_file(self, code_content: str, language: str) -> File:
         """创建代码文件"""
         # 确定文件扩展名
-        ext_map = {
-            'python': 'py', 'javascript': 'js', 'java': 'java', 'cpp': 'cpp',
-            'c': 'c', 'html': 'html', 'css': 'css', 'sql': 'sql',
-            'bash': 'sh', 'shell': 'sh', 'php': 'php', 'ruby': 'rb',
-            'go': 'go', 'rust': 'rs', 'typescript': 'ts', 'json': 'json',
-            'xml': 'xml', 'yaml': 'yml', 'markdown': 'md', 'text': 'txt'
-        }
-        
-        ext = ext_map.get(language.lower(), 'txt')
-        filename = f"code_{uuid.uuid4().hex[:8]}.{ext}"
+        ext = _LANG_EXT.get(language.lower(), 'txt')
+        filename = f"code_{os.urandom(4).hex()}.{ext}"
         filepath = os.path.join(self.FILE_CACHE_DIR, filename)
         
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(code_content)
+            # 在线程中写入，长代码不会阻塞事件循环上的其他渲染和消息处理
+            await asyncio.to_thread(_write_file_atomic, filepath, code_content.encode('utf-8'))
             
             # 使用正确的File组件创建方式
             return File(file=filepath, name=filename)
@@ -1304,29 +1898,167 @@ $$E=mc^2$$
             logger.error(f"创建代码文件失败: {e}")
             return None
 
+    async def _submit_render(self, md_content: str) -> bytes:
+        """提交渲染请求并返回图片字节，等待窗口内提交的请求合并为一次页面渲染"""
+        if self._closed:
+            raise RuntimeError("插件已停止，无法渲染")
+        future = asyncio.get_running_loop().create_future()
+        self._pending_renders.append((md_content, future))
+        if self._render_flush_task is None:
+            self._render_flush_task = asyncio.create_task(self._flush_renders())
+            self._flush_tasks.add(self._render_flush_task)
+            self._render_flush_task.add_done_callback(self._flush_tasks.discard)
+        return await future
+
+    async def _flush_renders(self):
+        """渲染当前累积的全部请求"""
+        # 等待一个短窗口，让紧随其后的渲染请求（如流式输出的后续片段）一起入队
+        await asyncio.sleep(max(self._render_wait_ms, 0) / 1000)
+        batch = self._pending_renders
+        self._pending_renders = []
+        self._render_flush_task = None
+        
+        try:
+            # 插件已停止时不再启动浏览器，未完成的请求在 finally 中统一失败
+            if self._closed:
+                return
+            page_pool = await self._get_page_pool()
+            # 页面池不可用时退回常驻浏览器，仍避免每次渲染都启动新的浏览器进程
+            browser = None if page_pool is not None else await self._get_browser()
+            if self._closed:
+                return
+            try:
+                images = await markdown_chunks_to_images_playwright(
+                    [md_content for md_content, _ in batch],
+                    scale=self._render_scale,
+                    width=self._render_width,
+                    browser=browser,
+                    page_pool=page_pool,
+                    image_type=self._image_type
+                )
+            except Exception as e:
+                if len(batch) == 1:
+                    if not batch[0][1].done():
+                        batch[0][1].set_exception(e)
+                    return
+                # 合并渲染失败时逐个重试，避免单个片段拖垮整批
+                logger.warning(f"合并渲染失败，改为逐个渲染: {e}")
+                for md_content, future in batch:
+                    try:
+                        single_images = await markdown_chunks_to_images_playwright(
+                            [md_content],
+                            scale=self._render_scale,
+                            width=self._render_width,
+                            browser=browser,
+                            page_pool=page_pool,
+                            image_type=self._image_type
+                        )
+                    except Exception as single_error:
+                        if not future.done():
+                            future.set_exception(single_error)
+                    else:
+                        if not future.done():
+                            future.set_result(single_images[0])
+                return
+            for (_, future), image_bytes in zip(batch, images):
+                if not future.done():
+                    future.set_result(image_bytes)
+        finally:
+            # 插件停止或任务被取消时，尚未完成的请求立即失败，避免调用方一直等待
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("渲染请求未完成，已取消"))
+
+    def _schedule_cache_write(self, path: str, image_bytes: bytes):
+        """在后台线程中写入图片缓存，不阻塞消息发送"""
+        async def write():
+            try:
+                await asyncio.to_thread(_write_file_atomic, path, image_bytes)
+            except OSError as e:
+                logger.warning(f"写入图片缓存失败: {e}")
+
+        task = asyncio.create_task(write())
+        # 保留任务引用，防止任务在完成前被回收
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def _schedule_render(self, md_content: str, fallback_text: str) -> asyncio.Task:
+        """
+        立即开始渲染并返回任务，任务结果为图片组件，渲染失败时为原文本
+        同一消息中的多个渲染因此可以并行，并合并到同一次页面渲染中
+        """
+        async def render():
+            image_component = await self._convert_markdown_to_image(md_content)
+            return image_component if image_component else Plain(fallback_text)
+        return asyncio.create_task(render())
+
+    def _remember_image(self, cache_key: str, image_bytes: bytes):
+        """把图片放入内存 LRU，按条数和总字节数淘汰最久未用的图片"""
+        cache = self._image_memory_cache
+        previous = cache.pop(cache_key, None)
+        if previous is not None:
+            self._image_memory_cache_bytes -= len(previous)
+        # 单张图片超过总预算时不缓存，避免把其他图片全部挤出
+        if len(image_bytes) > _IMAGE_MEMORY_CACHE_MAX_BYTES:
+            return
+        cache[cache_key] = image_bytes
+        self._image_memory_cache_bytes += len(image_bytes)
+        while (len(cache) > _IMAGE_MEMORY_CACHE_SIZE
+               or self._image_memory_cache_bytes > _IMAGE_MEMORY_CACHE_MAX_BYTES):
+            _, evicted = cache.popitem(last=False)
+            self._image_memory_cache_bytes -= len(evicted)
+
     async def _convert_markdown_to_image(self, md_content: str) -> Image:
         """将Markdown内容转换为图片"""
-        image_filename = f"{uuid.uuid4()}.png"
-        output_path = os.path.join(self.IMAGE_CACHE_DIR, image_filename)
+        scale = self._render_scale
+        width = self._render_width
+        # 以内容和渲染参数的哈希作为文件名，相同内容直接复用已生成的图片
+        # 缓存键不需要密码学强度，blake2b 比 sha256 更快，128 位摘要也足以避免冲突
+        cache_key = hashlib.blake2b(
+            f"{scale}|{width}|{code_font_size}|{line_height}|{md_content}".encode('utf-8'),
+            digest_size=16
+        ).hexdigest()
+        output_path = f"{self._image_cache_prefix}{cache_key}.{self._image_ext}"
+        
+        # 最近生成的图片直接从内存返回，不访问文件系统
+        image_bytes = self._image_memory_cache.get(cache_key)
+        if image_bytes is not None:
+            self._image_memory_cache.move_to_end(cache_key)
+            logger.info(f"命中内存图片缓存: {cache_key}")
+            return Image.fromBytes(image_bytes)
+        
+        # 文件系统操作放到线程中执行，避免在慢速存储上阻塞事件循环
+        if await asyncio.to_thread(_touch_if_exists, output_path):
+            logger.info(f"命中图片缓存: {output_path}")
+            return Image.fromFileSystem(output_path)
         
         try:
             logger.info(f"开始转换Markdown到图片，内容长度: {len(md_content)}")
-            if self.get_config_value("is_debug_mode", False):
+            if self._debug_mode:
                 logger.info(f"<DEBUG> 转换内容预览: {md_content[:200]}...")
             
-            await markdown_to_image_playwright(
-                md_text=md_content,
-                output_image_path=output_path,
-                scale=2,
-                width=600
-            )
+            # 相同内容已在渲染中时直接等待同一结果，由首个请求负责写入缓存
+            render_future = self._inflight_renders.get(cache_key)
+            owner = render_future is None
+            if owner:
+                render_future = asyncio.ensure_future(self._submit_render(md_content))
+                self._inflight_renders[cache_key] = render_future
+            try:
+                # shield 保证单个等待方被取消时不会取消共享的渲染
+                image_bytes = await asyncio.shield(render_future)
+            finally:
+                if owner:
+                    self._inflight_renders.pop(cache_key, None)
             
-            if os.path.exists(output_path):
-                file_size = os.path.getsize(output_path)
-                logger.info(f"图片生成成功: {output_path} (大小: {file_size} bytes)")
-                return Image.fromFileSystem(output_path)
+            # 截图字节直接交给消息组件发送，缓存文件在后台写入
+            if image_bytes:
+                logger.info(f"图片生成成功 (大小: {len(image_bytes)} bytes)")
+                if owner:
+                    self._schedule_cache_write(output_path, image_bytes)
+                self._remember_image(cache_key, image_bytes)
+                return Image.fromBytes(image_bytes)
             else:
-                logger.error(f"Markdown 图片生成失败: {output_path} 文件不存在")
+                logger.error("Markdown 图片生成失败: 截图为空")
                 return None
                 
         except Exception as e:
@@ -1401,12 +2133,7 @@ CONFIG_JSON = {
     "supported_code_languages": {
         "description": "支持发送为文件的代码语言列表",
         "type": "list",
-        "default": [
-            "python", "javascript", "java", "cpp", "c", 
-            "html", "css", "sql", "bash", "shell",
-            "php", "ruby", "go", "rust", "typescript",
-            "json", "xml", "yaml", "markdown"
-        ],
+        "default": list(_DEFAULT_SUPPORTED_LANGUAGES),
         "hint": "这些语言的代码可以被发送为文件"
     },
     "is_debug_mode": {
@@ -1426,11 +2153,27 @@ CONFIG_JSON = {
     "type": "float",
     "default": 1.5,
     "hint": "设置代码块渲染时的行高"
+  },
+  "image_format": {
+    "description": "渲染图片格式",
+    "type": "string",
+    "default": "jpg",
+    "options": ["jpg", "png"],
+    "hint": "jpg 编码更快、体积更小；png 为无损格式"
+  },
+  "render_wait_ms": {
+    "description": "合并渲染等待时间（毫秒）",
+    "type": "int",
+    "default": 80,
+    "hint": "在此时间窗口内提交的多个渲染请求会合并为一次浏览器渲染，设为0则只合并同时提交的请求"
   }
 }
+# 配置说明导入后只读，外层和每个配置项都不可修改
+CONFIG_JSON = MappingProxyType({key: MappingProxyType(option) for key, option in CONFIG_JSON.items()})
 
 if __name__ == "__main__":
     # 输出配置JSON
     print("配置选项JSON:")
-    print(json.dumps(CONFIG_JSON, ensure_ascii=False, indent=2))
+    # 只读映射不是 dict，序列化时按 dict 处理；只在直接运行时序列化，插件加载时不做这项工作
+    print(json.dumps(CONFIG_JSON, ensure_ascii=False, indent=2, default=dict))
     
@@ -0,0 +1,88 @@
+import importlib.util
+import logging
+import os
+import sys
+import tempfile
+import types
+
+# 插件是单文件模块，直接从仓库根目录导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _stub_module(name: str, **attrs):
+    """注册一个只含给定属性的替身模块，父包不存在时一并创建"""
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition('.')
+    if parent:
+        if parent not in sys.modules:
+            _stub_module(parent)
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def _stub_astrbot():
+    """AstrBot 只在宿主进程中提供，测试时用最小替身代替插件用到的接口"""
+
+    class _Filter:
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: (lambda func: func)
+
+    class Star:
+        def __init__(self, context):
+            self.context = context
+
+    class Plain:
+        def __init__(self, text):
+            self.text = text
+
+        def __repr__(self):
+            return f"Plain({self.text!r})"
+
+    class Image:
+        def __init__(self, src):
+            self.src = src
+
+        @classmethod
+        def fromFileSystem(cls, path):
+            return cls(path)
+
+        @classmethod
+        def fromBytes(cls, data):
+            return cls(data)
+
+    class File:
+        def __init__(self, file, name):
+            self.file = file
+            self.name = name
+
+    class StarTools:
+        @staticmethod
+        def get_data_dir(name=None):
+            return tempfile.mkdtemp(prefix="md2img_test_")
+
+    _stub_module('astrbot.api', logger=logging.getLogger("astrbot"))
+    _stub_module('astrbot.api.event', filter=_Filter(), AstrMessageEvent=type('AstrMessageEvent', (), {}))
+    _stub_module('astrbot.api.star', Context=type('Context', (), {}), Star=Star,
+                 register=lambda *args, **kwargs: (lambda cls: cls))
+    _stub_module('astrbot.core.message.components', Image=Image, Plain=Plain, File=File)
+    _stub_module('astrbot.core.provider.entities', LLMResponse=type('LLMResponse', (), {}),
+                 ProviderRequest=type('ProviderRequest', (), {}))
+    _stub_module('astrbot.core.star.star_tools', StarTools=StarTools)
+
+
+def _stub_playwright():
+    """未安装 Playwright 时提供导入所需的名字，测试不会启动浏览器"""
+
+    def async_playwright():
+        raise RuntimeError("测试环境未安装 Playwright")
+
+    _stub_module('playwright.async_api', async_playwright=async_playwright,
+                 Error=type('Error', (Exception,), {}))
+
+
+if importlib.util.find_spec('astrbot') is None:
+    _stub_astrbot()
+if importlib.util.find_spec('playwright') is None:
+    _stub_playwright()
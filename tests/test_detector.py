@@ -0,0 +1,93 @@
+import random
+import re
+
+import pytest
+
+from main import (
+    MarkdownComplexityDetector,
+    _count_blockquotes,
+    _count_math_delimiters,
+    _count_nested_lists,
+    _count_tables,
+)
+
+# 原先逐模式计分使用的正则，逐行扫描和 $ 位置扫描的结果须与之一致
+OLD_MATH_BLOCK_RE = re.compile(r'\$\$[\s\S]*?\$\$', re.MULTILINE)
+OLD_MATH_INLINE_RE = re.compile(r'\$[^$]+\$')
+OLD_COMPLEX_LIST_RE = re.compile(
+    r'^(?:\s*[-*+]|\s*\d+\.)\s+.*$(?:\n^(?:\s{4,}[-*+]|\s{4,}\d+\.)\s+.*$)+', re.MULTILINE)
+OLD_TABLE_RE = re.compile(r'\|.*\|.*\n\|.*---.*\|.*\n(\|.*\|.*\n)*', re.MULTILINE)
+OLD_BLOCKQUOTE_RE = re.compile(r'^>+.*$(?:\n^>+.*$)*', re.MULTILINE)
+
+
+def random_texts(pieces, count, max_pieces, separator='', seed=0):
+    """由给定片段随机拼接测试文本，固定种子保证结果可复现"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield separator.join(rng.choice(pieces) for _ in range(rng.randint(0, max_pieces)))
+
+
+@pytest.fixture
+def detector():
+    return MarkdownComplexityDetector()
+
+
+def test_dollar_before_code_fence_keeps_code_block_score(detector):
+    # 正文中的 $ 不能吞掉其后的代码块：代码块2分 + 行内公式1分
+    text = "It costs $5 a month. Run:\n```bash\necho $HOME\n```"
+    assert detector.needs_rendering(text, 3)
+
+
+def test_crlf_table_is_detected(detector):
+    text = "| a | b |\r\n|---|---|\r\n| 1 | 2 |\r\n"
+    assert detector.needs_rendering(text, 3)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("", (0, 0)),
+    ("$", (0, 0)),
+    ("$x$", (0, 1)),
+    ("$$", (0, 0)),
+    ("$$$", (0, 0)),
+    ("$$$$", (1, 0)),
+    ("$$x$$", (1, 1)),
+    ("$a$ and $$\nb\n$$ and $c", (1, 3)),
+])
+def test_count_math_delimiters_examples(text, expected):
+    assert _count_math_delimiters(text) == expected
+
+
+def test_count_math_delimiters_matches_per_pattern_regexes():
+    pieces = ['$', '$$', 'a', ' ', '\n', '$x', 'x$']
+    for text in random_texts(pieces, 20000, 16):
+        expected = (len(OLD_MATH_BLOCK_RE.findall(text)), len(OLD_MATH_INLINE_RE.findall(text)))
+        assert _count_math_delimiters(text) == expected, repr(text)
+
+
+def test_nested_list_separated_by_blank_lines_is_counted():
+    text = "- parent\n\n    - child\n\n    - another child\n- next"
+    assert _count_nested_lists(text.split('\n')) == 1
+
+
+def test_count_nested_lists_matches_old_regex():
+    pieces = ['- a', '    - b', '  * c', '1. x', '        2. y', '', 'text', '    text', '   - z', '\t- t']
+    for text in random_texts(pieces, 20000, 10, separator='\n'):
+        assert _count_nested_lists(text.split('\n')) == len(OLD_COMPLEX_LIST_RE.findall(text)), repr(text)
+
+
+def test_count_tables_matches_old_regex():
+    # 分隔行只取真正的表头分隔行，其余写法不再视为表格
+    pieces = ['| a | b |', '|a|b|', 'a | b | c', '|---|---|', '| :-- | --: |', '|x|', 'text', '', '|']
+    for text in random_texts(pieces, 20000, 10, separator='\n'):
+        assert _count_tables(text.split('\n')) == len(OLD_TABLE_RE.findall(text)), repr(text)
+
+
+def test_table_separator_needs_only_delimiter_characters():
+    assert _count_tables("| a | b |\n| --- | --- |\n".split('\n')) == 1
+    assert _count_tables("| a | b |\n| a---b | c |\n".split('\n')) == 0
+
+
+def test_count_blockquotes_matches_old_regex():
+    pieces = ['> q', '>> qq', '>', 'text', '', ' > indented']
+    for text in random_texts(pieces, 20000, 10, separator='\n'):
+        assert _count_blockquotes(text.split('\n')) == len(OLD_BLOCKQUOTE_RE.findall(text)), repr(text)
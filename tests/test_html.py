@@ -0,0 +1,123 @@
+import re
+
+import pytest
+
+from main import _MARKDOWN, preprocess_math_formulas, process_code_blocks_in_html
+
+bs4 = pytest.importorskip("bs4")
+
+
+def normalize(html: str) -> str:
+    """解析后重新序列化，只比较文档结构，不比较实体写法等细节"""
+    return str(bs4.BeautifulSoup(html, 'html.parser'))
+
+
+def old_process_code_blocks_in_html(html_content: str) -> str:
+    """原先基于 BeautifulSoup 的代码块处理"""
+    soup = bs4.BeautifulSoup(html_content, 'html.parser')
+    for pre in soup.find_all('pre'):
+        code = pre.find('code')
+        if not code:
+            continue
+        lang = 'text'
+        if code.get('class'):
+            match = re.search(r'language-(\w+)', ' '.join(code.get('class')))
+            if match:
+                lang = match.group(1)
+        text_content = code.get_text()
+        lines = text_content.split('\n')
+        while lines and lines[-1] == '':
+            lines.pop()
+        if not lines:
+            lines = ['']
+        container = soup.new_tag('div', attrs={'class': 'code-container'})
+        header = soup.new_tag('div', attrs={'class': 'code-header'})
+        header.string = lang
+        container.append(header)
+        content = soup.new_tag('div', attrs={'class': 'code-content'})
+        line_nums = soup.new_tag('div', attrs={'class': 'line-numbers'})
+        for i in range(1, len(lines) + 1):
+            line_num = soup.new_tag('div', attrs={'class': 'line-number'})
+            line_num.string = str(i)
+            line_nums.append(line_num)
+        content.append(line_nums)
+        code_wrapper = soup.new_tag('div', attrs={'class': 'code-wrapper'})
+        new_pre = soup.new_tag('pre')
+        new_code = soup.new_tag('code', attrs={'class': code.get('class', [])})
+        new_code.string = text_content
+        new_pre.append(new_code)
+        code_wrapper.append(new_pre)
+        content.append(code_wrapper)
+        container.append(content)
+        pre.replace_with(container)
+    return str(soup)
+
+
+def old_preprocess_math_formulas(html_content: str) -> str:
+    """原先基于 BeautifulSoup 的公式预处理（依次处理 $...$、$$...$$、\\(...\\)、\\[...\\]）"""
+    soup = bs4.BeautifulSoup(html_content, 'html.parser')
+    for pattern, replacement in (
+        (re.compile(r'\$([^$]+)\$'), r'<span class="math-inline">\\(\1\\)</span>'),
+        (re.compile(r'\$\$(.*?)\$\$', re.DOTALL), r'<div class="math-block">\\[\1\\]</div>'),
+        (re.compile(r'\\\((.+?)\\\)'), r'<span class="math-inline">\\(\1\\)</span>'),
+        (re.compile(r'\\\[(.+?)\\\]', re.DOTALL), r'<div class="math-block">\\[\1\\]</div>'),
+    ):
+        for text_node in soup.find_all(string=True):
+            if text_node.parent and text_node.parent.name in ['script', 'style']:
+                continue
+            if pattern.search(text_node):
+                text_node.replace_with(bs4.BeautifulSoup(pattern.sub(replacement, text_node), 'html.parser'))
+    return str(soup)
+
+
+CODE_MARKDOWN = [
+    "```python\ndef f(x):\n    return x < 1 and \"ok\"\n```",
+    "```\nplain text\n\n\n```",
+    "text before\n\n```js\nconst a = '<b>';\n```\n\nand `inline` code",
+    "```bash\necho $HOME\n```\n\n```go\nfunc main() {}\n```",
+    "no code here",
+]
+
+
+@pytest.mark.parametrize("markdown", CODE_MARKDOWN)
+def test_process_code_blocks_matches_old_output(markdown):
+    html = _MARKDOWN(markdown)
+    assert normalize(process_code_blocks_in_html(html)) == normalize(old_process_code_blocks_in_html(html))
+
+
+# 原先的 $...$ 处理会把生成的 \\(...\\) 再包装一次，含 $ 的文本单独断言
+MATH_MARKDOWN = [
+    "Inline \\\\(a + b\\\\) here",
+    "Block:\n\n\\\\[\nx^2 + y^2\n\\\\]",
+    "Costs 5 dollars, no math",
+]
+
+
+@pytest.mark.parametrize("markdown", MATH_MARKDOWN)
+def test_preprocess_math_matches_old_output(markdown):
+    html = _MARKDOWN(markdown)
+    assert normalize(preprocess_math_formulas(html)) == normalize(old_preprocess_math_formulas(html))
+
+
+@pytest.mark.parametrize("markdown, formulas", [
+    ("Euler: $e^{i\\pi} + 1 = 0$ and $a_1$", ["e^{i\\pi} + 1 = 0", "a_1"]),
+    ("| a | b |\n|---|---|\n| $x$ | $y$ |", ["x", "y"]),
+])
+def test_inline_math_is_wrapped_once(markdown, formulas):
+    html = preprocess_math_formulas(_MARKDOWN(markdown))
+    assert html.count('<span class="math-inline">') == len(formulas)
+    for formula in formulas:
+        assert f'<span class="math-inline">\\({formula}\\)</span>' in html
+
+
+def test_display_math_is_one_block():
+    # 原先先处理行内公式，$$x$$ 会被拆成两侧各一个 $ 的行内公式
+    html = preprocess_math_formulas(_MARKDOWN("$$x^2$$"))
+    assert '<div class="math-block">\\[x^2\\]</div>' in html
+    assert 'math-inline' not in html
+
+
+def test_dollar_in_code_is_not_math():
+    html = preprocess_math_formulas(_MARKDOWN("Run `echo $HOME $PATH`\n\n```bash\necho $A $B\n```"))
+    assert 'math-inline' not in html
+    assert '$HOME $PATH' in html and '$A $B' in html
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import random
+import re
+import time
+
+import pytest
+
+from main import SmartMarkdownConverterPlugin, _prune_dir
+
+
+def random_texts(pieces, count, max_pieces, seed=0):
+    """由给定片段随机拼接测试文本，固定种子保证结果可复现"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield ''.join(rng.choice(pieces) for _ in range(rng.randint(0, max_pieces)))
+
+
+@pytest.fixture
+def plugin():
+    return SmartMarkdownConverterPlugin(None, {})
+
+
+def old_normalize_code_indentation(code_content: str) -> str:
+    """原先逐行处理的缩进规范化"""
+    normalized_lines = []
+    for line in code_content.split('\n'):
+        leading_whitespace = len(line) - len(line.lstrip())
+        if leading_whitespace > 0:
+            leading_chars = line[:leading_whitespace]
+            if '\t' in leading_chars:
+                tab_count = leading_chars.count('\t')
+                total_spaces = tab_count * 4 + len(leading_chars) - tab_count
+                line = ' ' * total_spaces + line[leading_whitespace:]
+            elif leading_whitespace % 4 != 0:
+                line = ' ' * (((leading_whitespace + 3) // 4) * 4) + line[leading_whitespace:]
+        normalized_lines.append(line)
+    return '\n'.join(normalized_lines)
+
+
+def test_normalize_code_indentation_matches_old_loop(plugin):
+    pieces = [' ', '  ', '    ', '\t', '\n', 'x', 'if a:', '\r\n', '　', '\f']
+    for code in random_texts(pieces, 20000, 12):
+        assert plugin._normalize_code_indentation(code) == old_normalize_code_indentation(code), repr(code)
+
+
+def make_files(directory, specs):
+    """按 (文件名, 大小, 距今秒数) 创建文件并设置修改时间"""
+    now = time.time()
+    for name, size, age in specs:
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        os.utime(path, (now - age, now - age))
+
+
+def test_prune_dir_evicts_oldest_like_old_size_eviction(tmp_path):
+    specs = [('a', 40, 50), ('b', 30, 40), ('c', 20, 30), ('d', 10, 20), ('e', 25, 10)]
+    make_files(tmp_path, specs)
+    # 原先的淘汰方式：按修改时间从旧到新删除，直到总大小不超过上限
+    total_size = sum(size for _, size, _ in specs)
+    expected_removed = []
+    for name, size, _ in sorted(specs, key=lambda spec: -spec[2]):
+        if total_size <= 60:
+            break
+        expected_removed.append(name)
+        total_size -= size
+
+    assert _prune_dir(str(tmp_path), max_bytes=60) == (len(expected_removed), total_size)
+    assert sorted(os.listdir(tmp_path)) == sorted(set('abcde') - set(expected_removed))
+
+
+def test_prune_dir_removes_expired_files_first(tmp_path):
+    make_files(tmp_path, [('old', 10, 7200), ('new', 10, 10)])
+    os.mkdir(tmp_path / 'subdir')
+    assert _prune_dir(str(tmp_path), max_age=3600) == (1, 10)
+    assert sorted(os.listdir(tmp_path)) == ['new', 'subdir']
+
+
+def old_md_tag_parts(text: str, respect_md_tags: bool):
+    """原先用 re.split 切分 <md> 标签的结果，('md', 内容) 渲染，('text', 文本) 继续处理"""
+    parts = re.split(r"(<md>.*?</md>)", text, flags=re.DOTALL) if respect_md_tags else [text]
+    result = []
+    for part in parts:
+        part = part.strip()
+        if not part:
+            continue
+        if part.startswith("<md>") and part.endswith("</md>"):
+            md_content = part[4:-5].strip()
+            if md_content:
+                result.append(('md', md_content))
+        else:
+            result.append(('text', part))
+    return result
+
+
+def md_tag_parts(plugin, text: str):
+    """记录 _smart_process_markdown 交给渲染和文本处理的各部分"""
+    async def process_text(part):
+        yield ('text', part)
+
+    plugin._process_text_with_blocks = process_text
+    plugin._schedule_render = lambda md_content, fallback_text: ('md', md_content)
+
+    async def collect():
+        return [component async for component in plugin._smart_process_markdown(text)]
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("respect_md_tags", [True, False])
+def test_smart_process_markdown_splits_like_old_version(respect_md_tags):
+    plugin = SmartMarkdownConverterPlugin(None, {'respect_md_tags': respect_md_tags})
+    pieces = ['<md>', '</md>', 'a', ' ', '\n', '<md', 'md>', '# h']
+    for text in random_texts(pieces, 5000, 10):
+        assert md_tag_parts(plugin, text) == old_md_tag_parts(text, respect_md_tags), repr(text)
+
+
+def test_wrapped_message_renders_without_respect_md_tags():
+    plugin = SmartMarkdownConverterPlugin(None, {'respect_md_tags': False})
+    assert md_tag_parts(plugin, " <md>\n# Title\n</md>\n") == [('md', '# Title')]
+    assert md_tag_parts(plugin, "text <md>x</md>") == [('text', 'text <md>x</md>')]